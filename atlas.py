@@ -0,0 +1,125 @@
+#! /usr/bin/python3
+
+import argparse
+import glob
+import hashlib
+import json
+import os
+import pygame
+from pygame.locals import *
+
+
+ART_DIR = 'art'
+CACHE_DIR = '.atlas'
+ATLAS_VERSION = 1  # bump when the variants below change
+ATLAS_WIDTH = 1024
+PROJECTILE_TRAIL_TRANSPARENCY = 25
+ROTATED = ('arrow', )  # left, right, up, down and the same as trails
+FLIPPED = ('hero', )  # left, right
+FADED = ('teleport', )  # 11 steps from transparent to opaque
+
+
+def resource_key(filename):
+    """ 'hero-12.png' and 'hero-3.png' are frames of 'hero', 'wall-dl.png' is 'wall-dl'. """
+    key = os.path.splitext(os.path.split(filename)[-1])[0]
+    if '-' in key:
+        try:
+            int(key.split('-')[-1])
+            key = key[:key.rfind('-')]
+        except ValueError:
+            pass
+    return key
+
+
+def make_transparent(img, alpha):
+    img = img.copy()
+    img.fill((255, 255, 255, int(alpha)), special_flags=BLEND_RGBA_MULT)
+    return img
+
+
+def variants(key, img):
+    if key in ROTATED:
+        rotate = pygame.transform.rotate
+        images = (img, rotate(img, 180), rotate(img, 270), rotate(img, 90))
+        return images + tuple(make_transparent(image, PROJECTILE_TRAIL_TRANSPARENCY) for image in images)
+    if key in FLIPPED:
+        return (img, pygame.transform.flip(img, True, False))
+    if key in FADED:
+        return tuple(make_transparent(img, i * 255 / 10) for i in range(11))
+    return (img, )
+
+
+def source_hash(art_dir):
+    digest = hashlib.sha256(str(ATLAS_VERSION).encode())
+    for filename in sorted(glob.glob(os.path.join(art_dir, '*.png'))):
+        digest.update(os.path.basename(filename).encode())
+        with open(filename, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+
+def build(art_dir):
+    """ Pack the art with all its variants into one image, shelf by shelf.
+        The index maps a resource key to its frames, each a list of variant rects. """
+    placed = []  # (key, variants of a frame)
+    for filename in sorted(glob.glob(os.path.join(art_dir, '*.png'))):
+        key = resource_key(filename)
+        img = pygame.image.load(filename)
+        placed.append((key, tuple(variants(key, img))))
+
+    index = {}
+    positions = []
+    x = y = shelf_height = 0
+    for key, images in placed:
+        rects = []
+        for img in images:
+            width, height = img.get_size()
+            if x + width > ATLAS_WIDTH:
+                x, y, shelf_height = 0, y + shelf_height, 0
+            rects.append((x, y, width, height))
+            positions.append((img, (x, y)))
+            x += width
+            shelf_height = max(shelf_height, height)
+        index.setdefault(key, []).append(rects)
+
+    atlas = pygame.Surface((ATLAS_WIDTH, y + shelf_height), SRCALPHA)
+    for img, pos in positions:
+        atlas.blit(img, pos, special_flags=BLEND_RGBA_MAX)  # copy pixels with their alpha as they are
+    return atlas, index
+
+
+def load(art_dir=ART_DIR, cache_dir=CACHE_DIR):
+    """ Atlas image and index of the art, built only if the art has changed since it got cached. """
+    name = os.path.join(cache_dir, source_hash(art_dir))
+    if os.path.exists(name + '.json') and os.path.exists(name + '.png'):
+        with open(name + '.json') as f:
+            return pygame.image.load(name + '.png'), json.load(f)
+
+    atlas, index = build(art_dir)
+    os.makedirs(cache_dir, exist_ok=True)
+    for filename in glob.glob(os.path.join(cache_dir, '*')):  # the art has changed, stale atlases are of no use
+        os.unlink(filename)
+    pygame.image.save(atlas, name + '.tmp.png')
+    os.replace(name + '.tmp.png', name + '.png')
+    with open(name + '.tmp.json', 'w') as f:
+        json.dump(index, f)
+    os.replace(name + '.tmp.json', name + '.json')  # written last, marks the cache complete
+    return atlas, index
+
+
+def sprites(atlas, index):
+    """ Resource key -> frames, each a tuple of its variants, sharing the pixels of the atlas. """
+    return {key: [tuple(atlas.subsurface(rect) for rect in rects) for rects in frames] for key, frames in index.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Pack the art into a cached sprite atlas')
+    parser.add_argument('--art-dir', default=ART_DIR)
+    parser.add_argument('--cache-dir', default=CACHE_DIR)
+    args = parser.parse_args()
+    atlas, index = load(args.art_dir, args.cache_dir)
+    print(f'{sum(len(frames) for frames in index.values())} frames of {len(index)} resources, atlas {atlas.get_width()}x{atlas.get_height()}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+from util import changed_spans
+
+
+WALLS = '-|'
+EMPTY, FLOOR, DOOR, WALL = 0, 1, 2, 3  # tile codes, a wall is WALL + the mask of its neighbouring walls
+UP, DOWN, LEFT, RIGHT = 1, 2, 4, 8
+WALL_SUFFIXES = {
+    0: '',
+    UP | DOWN: '-v',
+    UP: '-u',
+    DOWN: '-d',
+    LEFT | RIGHT: '-h',
+    LEFT: '-l',
+    RIGHT: '-r',
+    UP | LEFT: '-dr',
+    UP | RIGHT: '-dl',
+    DOWN | LEFT: '-ur',
+    DOWN | RIGHT: '-ul',
+    UP | DOWN | RIGHT: '-vr',
+    UP | DOWN | LEFT: '-vl',
+    DOWN | LEFT | RIGHT: '-hd',
+    UP | LEFT | RIGHT: '-hu',
+}  # there is no art for a crossing, it is drawn as a lone wall
+TILES = (None, 'floor', 'door-closed') + tuple('wall' + WALL_SUFFIXES.get(mask, '') for mask in range(16))  # code -> art key
+
+
+def tile_code(maze, x, y):
+    cell = maze.get(x, y)
+    if cell == '.':
+        return FLOOR
+    if cell == '+':
+        return DOOR
+    if cell in WALLS:
+        return WALL + (
+            (UP if y > 0 and maze.get(x, y - 1) in WALLS else 0) |
+            (DOWN if y < maze.height - 1 and maze.get(x, y + 1) in WALLS else 0) |
+            (LEFT if x > 0 and maze.get(x - 1, y) in WALLS else 0) |
+            (RIGHT if x < maze.width - 1 and maze.get(x + 1, y) in WALLS else 0))
+    return EMPTY
+
+
+class AutotileIndex:
+    """ Tile code of every maze cell, a bytearray per row, recomputed only around the cells
+        changed since, like opened doors. The map is looked at only when maze.revision or
+        the changes the client has predicted on top of it are new. """
+
+    def __init__(self):
+        self.rows = []
+        self._map = None  # the cells the codes are for
+        self._revision = None
+        self._local_changes = None
+
+    def tile(self, x, y):
+        return TILES[self.rows[y][x]]
+
+    def update(self, maze):
+        """ Catch up with the maze. Returns the cells whose code has changed. """
+        if maze.revision == self._revision and maze.local_changes == self._local_changes:
+            return []
+        self._revision, self._local_changes = maze.revision, list(maze.local_changes)
+        spans = changed_spans(self._map, maze.map)
+        if not spans:
+            return []
+        width, height = maze.width, maze.height
+        if len(self.rows) != height or any(len(row) != width for row in self.rows):
+            self.rows = [bytearray(width) for _ in range(height)]
+            self._map = [[None] * width for _ in range(height)]
+
+        cells = set()
+        for y, x0, x1 in spans:
+            self._map[y][x0:x1 + 1] = maze.map[y][x0:x1 + 1]
+            for ny in range(max(y - 1, 0), min(y + 2, height)):  # a wall takes its shape from the neighbours
+                cells.update((x, ny) for x in range(max(x0 - 1, 0), min(x1 + 2, width)))
+        changed = []
+        for x, y in cells:
+            code = tile_code(maze, x, y)
+            if self.rows[y][x] != code:
+                self.rows[y][x] = code
+                changed.append((x, y))
+        return changed
@@ -0,0 +1,81 @@
+import random
+
+from model import *
+from ops import *
+from pathfinding import NEIGHBOURS
+
+
+BOT_INIT_HP = 6
+BOT_INIT_DAMAGE = 1
+BOT_SIGHT_RADIUS = 8
+BOT_MOVE_COOLDOWN = 1
+BOT_MELEE_COOLDOWN = 2
+
+
+class BotEngine:
+    """ AI-controlled units of a single game. All bots act in one batched pass per tick:
+        perception (who stands where, what players can see) is built once and shared,
+        and bot actions go straight to the *Op classes instead of through Server.serve. """
+
+    def __init__(self, game, pathfinder, timers):
+        self._game = game
+        self._pathfinder = pathfinder
+        self._timers = timers
+        self.bot_ids = set()
+
+    def add_bot(self):
+        bot = Unit(hp=BOT_INIT_HP, damage=BOT_INIT_DAMAGE)
+        GameOp(self._game).spawn_unit(bot)
+        self.bot_ids.add(bot.id)
+        return bot.id
+
+    def tick(self):
+        game = self._game
+        self.bot_ids.intersection_update(game.entities.keys())
+        if not self.bot_ids:
+            return False
+
+        # shared perception
+        occupied = game.occupied_cells
+        walkable = self._pathfinder.walkable
+        targets = [unit for unit in game.units if unit.player_id]
+
+        game_changed = False
+        for bot_id in list(self.bot_ids):
+            bot = game.entities[bot_id]
+            target = self._pick_target(bot, targets)
+            if target and max(abs(target.x - bot.x), abs(target.y - bot.y)) <= 1:
+                if not self._timers.active((bot_id, 'melee')):
+                    GameOp(game).hit(target, bot.damage)
+                    self._timers.schedule((bot_id, 'melee'), BOT_MELEE_COOLDOWN)
+                    if target.dead:
+                        targets.remove(target)
+                        occupied.discard(target.pos)
+                    game_changed = True
+                continue
+
+            if self._timers.active((bot_id, 'move')):
+                continue
+
+            if target:
+                step = self._pathfinder.next_step(bot.pos, target.pos, blocked=occupied)
+            else:
+                steps = [(bot.x + dx, bot.y + dy) for dx, dy in NEIGHBOURS]
+                step = random.choice([cell for cell in steps if cell in walkable and cell not in occupied] or [None])
+            if step:
+                occupied.discard(bot.pos)
+                EntityOp(bot).move(*step)
+                occupied.add(step)
+                self._timers.schedule((bot_id, 'move'), BOT_MOVE_COOLDOWN)
+                game_changed = True
+        return game_changed
+
+    def _pick_target(self, bot, targets):
+        """ Nearest player unit within sight. A bot sees a player exactly when
+            the player sees the bot, so no line of sight is computed here. """
+        best, best_dist = None, BOT_SIGHT_RADIUS + 1
+        for target in targets:
+            dist = max(abs(target.x - bot.x), abs(target.y - bot.y))
+            if dist < best_dist and self._game.get_visibility(target.player_id, bot.x, bot.y) > 0.5:
+                best, best_dist = target, dist
+        return best
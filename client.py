@@ -1,9 +1,118 @@
+from collections import deque
+from copy import copy
 import logging
 from time import time
 
 from connection import *
 from ops import *
 from protocol import *
+from util import percentile
+
+
+TRACE_WINDOW = 1000
+MAX_PENDING_TRACES = 100
+TRACE_STAGES = ('rtt', 'network', 'queue', 'serve', 'tick', 'encode', 'send')
+CLOCK_SAMPLES = 16
+MIN_DRIFT_SPAN = 30  # seconds of samples needed before drift is estimated
+SNAPSHOT_BUFFER = 32
+INTERPOLATION_DELAY = MAX_UPDATE_INTERVAL + MIN_UPDATE_INTERVAL  # the server sends changes at least every MAX_UPDATE_INTERVAL, the rest is slack for jitter
+
+
+class TraceStats:
+    """ Latency breakdown of the last TRACE_WINDOW traced requests, per stage. """
+
+    def __init__(self):
+        self.samples = {stage: deque(maxlen=TRACE_WINDOW) for stage in TRACE_STAGES}
+
+    def add(self, timings):
+        for stage, value in timings.items():
+            self.samples[stage].append(value)
+
+    def percentile(self, stage, p):
+        return percentile(self.samples[stage], p)
+
+    def summary(self):
+        return {stage: (self.percentile(stage, 50), self.percentile(stage, 95), self.percentile(stage, 99))
+                for stage in TRACE_STAGES if self.samples[stage]}
+
+
+class ClockSync:
+    """ NTP-style estimate of the server clock from ping round trips. Offsets measured
+        with the lowest delay are the least affected by asymmetric queueing, so only
+        those are trusted; drift is the slope of the offset over local time. """
+
+    def __init__(self):
+        self.samples = deque(maxlen=CLOCK_SAMPLES)  # (local_time, offset, delay)
+        self.offset = 0
+        self.drift = 0
+        self.ref_time = 0
+        self.last_sample_ts = None
+
+    @property
+    def synced(self):
+        return bool(self.samples)
+
+    def add_sample(self, client_send_time, server_time, client_receive_time):
+        delay = client_receive_time - client_send_time
+        offset = server_time - (client_send_time + client_receive_time) / 2
+        self.samples.append((client_receive_time, offset, delay))
+        self.last_sample_ts = client_receive_time
+
+        best = sorted(self.samples, key=lambda sample: sample[2])[:max(len(self.samples) // 2, 1)]
+        self.ref_time, self.offset, _ = min(best, key=lambda sample: sample[2])
+        self.drift = 0
+        if len(best) >= 2 and max(sample[0] for sample in best) - min(sample[0] for sample in best) >= MIN_DRIFT_SPAN:
+            mean_t = sum(sample[0] for sample in best) / len(best)
+            mean_o = sum(sample[1] for sample in best) / len(best)
+            var = sum((sample[0] - mean_t) ** 2 for sample in best)
+            self.drift = sum((sample[0] - mean_t) * (sample[1] - mean_o) for sample in best) / var
+
+    def server_time(self, local_time):
+        return local_time + self.offset + self.drift * (local_time - self.ref_time)
+
+
+def interpolate(snapshots, render_time):
+    """ Unit positions at render_time from (server_time, {unit_id: pos}) snapshots in time order. """
+    if not snapshots:
+        return {}
+    older = newer = snapshots[0]
+    for snapshot in snapshots:
+        newer = snapshot
+        if snapshot[0] >= render_time:
+            break
+        older = snapshot
+    span = newer[0] - older[0]
+    fraction = min(max((render_time - older[0]) / span, 0), 1) if span else 1
+    positions = {}
+    for unit_id, (x1, y1) in newer[1].items():
+        x0, y0 = older[1].get(unit_id, (x1, y1))
+        if max(abs(x1 - x0), abs(y1 - y0)) > MAX_JUMP_DISTANCE:  # teleported, don't slide across the maze
+            x0, y0 = x1, y1
+        positions[unit_id] = (x0 + (x1 - x0) * fraction, y0 + (y1 - y0) * fraction)
+    return positions
+
+
+class ClientSnapshot:
+    """ What the client knows at a moment, for reading while the client goes on changing.
+        Offers the same view of the game as the Client itself, but for the visibility of other players. """
+
+    def __init__(self, client):
+        self.game = GameOp(client.game).copy(client.player_id) if client.game else None
+        self.game_id = client.game_id
+        self.player_id = client.player_id
+        self.clock = copy(client.clock)  # only the estimate, the samples are not used
+        self.snapshots = tuple(client.snapshots)
+        self.interpolation_delay = client.interpolation_delay
+
+    @property
+    def char(self):
+        return next(iter(self.game.units_by_player[self.player_id]), None)
+
+    def server_now(self):
+        return self.clock.server_time(time())
+
+    def interpolated_positions(self):
+        return interpolate(self.snapshots, self.server_now() - self.interpolation_delay)
 
 
 class Client:
@@ -17,48 +126,194 @@ class Client:
         self.last_server_msg_ts = None
         self.last_ping_time = None
         self.reconnect_backoff = 1  # not ideal place for it
+        self.tracing = False
+        self.next_trace_id = 1
+        self.pending_traces = {}  # trace_id -> timings waiting for TraceTimings
+        self.trace_stats = TraceStats()
+        self.clock = ClockSync()
+        self.prediction = True
+        self.next_seq = 1
+        self.pending_inputs = []  # inputs not yet acknowledged by the server, in seq order
+        self.tick_server_time = None  # server time of the update the game tick comes from
+        self.jump_tick_alias = None  # (server jump_tick, predicted jump_tick) of the last confirmed jump
+        self.snapshots = deque(maxlen=SNAPSHOT_BUFFER)  # (server_time, {unit_id: pos}) of remote units
+        self.interpolation_delay = INTERPOLATION_DELAY
+        self.publish_snapshots = False
+        self.snapshot = None  # published on changes if publish_snapshots, never changed afterwards
+        self.snapshot_stale = False  # changed since the snapshot was published
+        self.entity_listeners = []  # told of entities appearing and disappearing, see GameOp.update_from
+
+    def send(self, request):
+        if self.tracing:
+            request = TracedRequest(self.next_trace_id, time(), request)
+            self.next_trace_id += 1
+        self.connection.outgoing.append(request)
 
     def fetch_game(self):
-        self.connection.outgoing.append(GetGameRequest(self.game_id, self.player_id))
+        self.send(GetGameRequest(self.game_id, self.player_id))
 
     def handle(self, message):
         if isinstance(message, GetGameResponse):
             if not self.game:
                 self.game = message.game
+                for entity in self.game.entities.values():
+                    self.entity_added(entity)
             else:
-                GameOp(self.game).update_from(message.game)
+                GameOp(self.game).update_from(message.game, self)
+            if message.server_time:
+                self.tick_server_time = message.server_time
+            self.reconcile(message.ack_seq)
+            if message.server_time:
+                self.record_snapshot(message.server_time)
             self.fetch_count += 1
         elif isinstance(message, PingResponse):
             if self.last_ping_ts:
                 self.last_ping_time = time() - self.last_ping_ts
                 logging.debug('Ping %f ms', self.last_ping_time * 1000)
             self.last_ping_ts = None
+            if message.client_time:
+                self.clock.add_sample(message.client_time, message.server_time, time())
+        elif isinstance(message, BatchResponse):
+            for response in message.responses:
+                self.handle(response)
+        elif isinstance(message, TracedResponse):
+            timings = dict(message.timings, rtt=time() - message.client_time)
+            self.pending_traces[message.trace_id] = timings
+            while len(self.pending_traces) > MAX_PENDING_TRACES:
+                del self.pending_traces[next(iter(self.pending_traces))]
+            if message.response:
+                self.handle(message.response)
+        elif isinstance(message, TraceTimings):
+            if timings := self.pending_traces.pop(message.trace_id, None):
+                timings.update(message.timings)
+                # requests of one batch overlap on the server, hence the clamp
+                timings['network'] = max(timings['rtt'] - sum(value for stage, value in timings.items() if stage != 'rtt'), 0)
+                self.trace_stats.add(timings)
+
+    def entity_added(self, entity):
+        for listener in self.entity_listeners:
+            listener.entity_added(entity)
+
+    def entity_removed(self, entity):
+        for listener in self.entity_listeners:
+            listener.entity_removed(entity)
+
+    def send_input(self, request):
+        """ Send an input the server acknowledges by seq, applying it locally right away. """
+        request.seq = self.next_seq
+        self.next_seq += 1
+        if self.prediction:
+            predicted_tick = self.server_tick() if self.game else None
+            self.pending_inputs.append((request, predicted_tick))
+            self.snapshot_stale = self.predict(request, predicted_tick) or self.snapshot_stale
+        self.send(request)
+
+    def predict(self, request, tick):
+        """ Apply an input to the local game by the same rules the server uses, cooldowns included. """
+        if not self.game or request.unit_id not in self.game.entities:
+            return False
+        game = self.game
+        char = game.entities[request.unit_id]
+        if isinstance(request, MoveCharRequest):
+            if not GameOp(game).can_move(char, request.x, request.y, tick):
+                return False
+            EntityOp(char).move(request.x, request.y)
+            UnitOp(char).act('move', tick)
+            GameOp(game).update_visibility(self.player_id, char.x, char.y)
+        elif isinstance(request, JumpRequest):
+            if not GameOp(game).can_jump(char, request.x, request.y, tick):
+                return False
+            UnitOp(char).jump(request.x, request.y, tick, GameOp(game).walkable_cells)
+            UnitOp(char).act('jump', tick)
+            GameOp(game).update_visibility(self.player_id, char.x, char.y)
+        elif isinstance(request, OpenRequest):
+            if not GameOp(game).can_open(char, request.x, request.y):
+                return False
+            game.maze.set(request.x, request.y, '.')  # the revision stays the server's, a predicted one could match a server revision of another map
+            game.maze.local_changes.append((request.x, request.y))  # until the next update brings the server's map
+        return True
+
+    def reconcile(self, ack_seq):
+        """ The game has just been replaced by the authoritative state which includes
+            the inputs up to ack_seq; replay the ones the server hasn't seen yet. """
+        char = self.char
+        if ack_seq is not None:  # None until the server has seen an input, then all of them are pending
+            for request, predicted_tick in self.pending_inputs:
+                if request.seq > ack_seq:
+                    break
+                if isinstance(request, JumpRequest) and char and char.effects.jump_tick != predicted_tick:
+                    # the server stamped the jump with its own tick; keep the one shown already
+                    self.jump_tick_alias = (char.effects.jump_tick, predicted_tick)
+            self.pending_inputs = [(request, tick) for request, tick in self.pending_inputs if request.seq > ack_seq]
+
+        if char and self.jump_tick_alias and char.effects.jump_tick == self.jump_tick_alias[0]:
+            char.effects.jump_tick = self.jump_tick_alias[1]
+        for request, predicted_tick in self.pending_inputs:
+            self.predict(request, predicted_tick)
+
+    def record_snapshot(self, server_time):
+        positions = {entity.id: entity.pos for entity in self.game.entities.values()
+                     if isinstance(entity, Unit) and entity.player_id != self.player_id}
+        if self.snapshots and server_time <= self.snapshots[-1][0]:
+            self.snapshots.pop()
+        self.snapshots.append((server_time, positions))
+
+    def interpolated_positions(self):
+        """ Positions of remote units as they were interpolation_delay ago by the server clock,
+            so movement stays smooth however sparse the snapshots are. Own units are predicted instead. """
+        return interpolate(self.snapshots, self.server_now() - self.interpolation_delay)
+
+    def publish(self):
+        """ Replace the snapshot if anything has changed since, so a batch of changes costs
+            a single copy. The snapshot may be read by another thread meanwhile without locking:
+            the client changes its own state, never the published one. """
+        if self.publish_snapshots and self.game and self.snapshot_stale:
+            self.snapshot = ClientSnapshot(self)
+            self.snapshot_stale = False
 
     def process_connection(self):
         while self.connection.incoming:
             self.last_server_msg_ts = time()
             message = self.connection.incoming.pop(0)
             self.handle(message)
+            self.snapshot_stale = True
+        self.publish()
+
+    def batch_outgoing(self):
+        """ Pack everything queued since the last call into a single BatchRequest. """
+        if len(self.connection.outgoing) > 1:
+            batch = BatchRequest(self.connection.outgoing[:])
+            self.connection.outgoing[:] = [batch]
 
     def move_char(self, unit_id, x, y):
-        self.connection.outgoing.append(MoveCharRequest(self.game_id, self.player_id, unit_id, x, y))
+        self.send_input(MoveCharRequest(self.game_id, self.player_id, unit_id, x, y))
 
     @property
     def char(self):
         return next(iter(self.game.units_by_player[self.player_id]), None)
 
     def attack(self, unit_id, x, y):
-        self.connection.outgoing.append(AttackRequest(self.game_id, self.player_id, unit_id, x, y))
+        self.send(AttackRequest(self.game_id, self.player_id, unit_id, x, y))
 
     def open_door(self, unit_id, x, y):
-        self.connection.outgoing.append(OpenRequest(self.game_id, self.player_id, unit_id, x, y))
+        self.send_input(OpenRequest(self.game_id, self.player_id, unit_id, x, y))
 
     def fire(self, unit_id, x, y):
-        self.connection.outgoing.append(FireRequest(self.game_id, self.player_id, unit_id, x, y))
+        self.send(FireRequest(self.game_id, self.player_id, unit_id, x, y))
 
     def ping(self):
-        self.connection.outgoing.append(PingRequest())
         self.last_ping_ts = time()
+        self.send(PingRequest(self.last_ping_ts, self.last_ping_time))
+
+    def server_now(self):
+        return self.clock.server_time(time())
+
+    def server_tick(self):
+        """ The server's tick by now, counted on from the last update. Rather behind than ahead,
+            so an input whose cooldown is over here is over on the server too. """
+        if self.tick_server_time is None:
+            return self.game.tick
+        return self.game.tick + max(int((self.server_now() - self.tick_server_time) / TICK_INTERVAL), 0)
 
     def on_connected(self):
         self.last_ping_ts = None
@@ -67,7 +322,10 @@ class Client:
         self.fetch_game()
 
     def jump(self, unit_id, x, y):
-        self.connection.outgoing.append(JumpRequest(self.game_id, self.player_id, unit_id, x, y))
+        self.send_input(JumpRequest(self.game_id, self.player_id, unit_id, x, y))
 
     def teleport(self, unit_id, x, y):
-        self.connection.outgoing.append(TeleportRequest(self.game_id, self.player_id, unit_id, x, y))
+        self.send(TeleportRequest(self.game_id, self.player_id, unit_id, x, y))
+
+    def move_to(self, unit_id, x, y):
+        self.send(MoveToRequest(self.game_id, self.player_id, unit_id, x, y))
@@ -1,4 +1,63 @@
+MIN_UPDATE_INTERVAL = 0.05
+MAX_UPDATE_INTERVAL = 1.0
+UPDATES_PER_RTT = 2  # the player can't react to state refreshed more often than that
+MAX_LINK_SHARE = 0.5  # of the measured drain rate game updates may take
+SMOOTHING = 0.125
+MIN_SEND_SECONDS = 0.001  # sends that don't wait for the socket to drain tell nothing about the link
+
+
 class Connection:
-    def __init__(self):
+    def __init__(self, game_id=None, player_id=None):
+        self.game_id = game_id
+        self.player_id = player_id
         self.incoming = []
         self.outgoing = []
+        self.last_seen_ts = None
+
+        # adaptive game state updates, see update_due
+        self.rtt = None  # as reported by the client
+        self.drain_rate = None  # bytes per second
+        self.update_bytes = None
+        self.update_interval = MIN_UPDATE_INTERVAL
+        self.last_update_ts = None
+        self.dirty = False
+        self.urgent = False
+
+    def report_rtt(self, rtt):
+        self.rtt = _smooth(self.rtt, rtt)
+        self._adapt()
+
+    def report_send(self, size, seconds, update=False):
+        if seconds >= MIN_SEND_SECONDS:
+            self.drain_rate = _smooth(self.drain_rate, size / seconds)
+        if update:
+            self.update_bytes = _smooth(self.update_bytes, size)
+        self._adapt()
+
+    def update_due(self, now):
+        """ Whether the changed game state should be sent now. Changes are coalesced
+            for update_interval, urgent ones only for MIN_UPDATE_INTERVAL. """
+        if not self.dirty:
+            return False
+        if self.last_update_ts is None:
+            return True
+        interval = MIN_UPDATE_INTERVAL if self.urgent else self.update_interval
+        return now - self.last_update_ts >= interval
+
+    def updated(self, now):
+        self.dirty = self.urgent = False
+        self.last_update_ts = now
+
+    def _adapt(self):
+        interval = MIN_UPDATE_INTERVAL
+        if self.rtt is not None:
+            interval = max(interval, self.rtt / UPDATES_PER_RTT)
+        if self.drain_rate and self.update_bytes:
+            interval = max(interval, self.update_bytes / self.drain_rate / MAX_LINK_SHARE)
+        self.update_interval = min(interval, MAX_UPDATE_INTERVAL)
+
+
+def _smooth(average, value):
+    if average is None:
+        return value
+    return average + SMOOTHING * (value - average)
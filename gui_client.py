@@ -3,11 +3,9 @@
 import argparse
 import asyncio
 import aiohttp
-from collections import defaultdict, deque
+from collections import Counter, defaultdict, deque
 import copy
 import enum
-import glob
-from itertools import chain
 import json
 import logging
 import math
@@ -18,22 +16,45 @@ import random
 from threading import Thread, Lock, Event
 import time
 
-from client import Client
+import atlas
+from autotile import AutotileIndex
+from client import Client, CLOCK_SAMPLES
 from connection import Connection
 from messaging import Codec
 import model
+import ops
 from protocol import *
+from util import changed_spans, percentile
 
 
 MAX_MESSAGE_FRESHNESS = 20
 PING_TIMEOUT = 10
 MAX_RECONNECT_BACKOFF = 120
+TRACE_LOG_INTERVAL = 10
+CLOCK_SYNC_INTERVAL = 5
 PROJECTILE_TRAIL_BUFFER = 10
-PROJECTILE_TRAIL_TRANSPARENCY = 25
 WALK_SPEED = 3
 JUMP_SPEED = 4
 TELEPORT_TIME = 0.75
 TAKE_DAMAGE_TIME = 0.5
+MAX_DIRTY_RECTS = 64 # more than that, the whole screen gets redrawn
+VIEWPORT_WIDTH = 20 # cells
+VIEWPORT_HEIGHT = 14
+CAMERA_MARGIN = 4 # cells between the char and the edge of the view before it scrolls
+CULL_MARGIN = 2 # cells around the view still drawn, for what moves into it
+FOG_ALPHA = tuple(int(255 / 11 * (11 - i)) for i in range(11)) # by tenths of visibility
+TARGET_FPS = 60
+MAX_FRAME_DEBT = 3 # frames a late frame loop may hurry to catch up with, the rest are skipped
+STATS_WINDOW = 300 # frames
+STATS_LOG_INTERVAL = 10
+STATS_OVERLAY_INTERVAL = 0.5
+BENCH_FRAMES = 1000
+BENCH_MAZE_SIZE = (60, 40)
+BENCH_UNITS = 20
+BENCH_ARROWS = 10
+BENCH_TICK_FRAMES = 6 # frames per game tick, as with a 10 Hz server at 60 FPS
+BENCH_ARROW_FRAMES = 30 # frames the arrows fly before they are fired anew
+BENCH_ARROW_SPEED = 20 # cells per second, as the server fires them
 
 
 async def read_socket(ws, codec, connection, lock, client):
@@ -51,12 +72,14 @@ async def read_socket(ws, codec, connection, lock, client):
             break
 
 
-async def write_socket(ws, codec, connection, lock):
+async def write_socket(ws, codec, client, lock):
+    connection = client.connection
     while not ws.closed:
         with lock:
-            while connection.outgoing:
-                message = connection.outgoing.pop(0)
-                await ws.send_str(codec.encode(message))
+            client.batch_outgoing()
+            messages, connection.outgoing[:] = connection.outgoing[:], []
+        for message in messages: # not under the lock, sending may take a while
+            await ws.send_str(codec.encode(message))
         await asyncio.sleep(0)
 
 
@@ -66,7 +89,13 @@ async def wait_stop_flag(stop_flag, ws):
 
 
 async def check_connection(session, client, stop_flag, reconnect_flag):
+    last_trace_log_ts = time.time()
     while not stop_flag.is_set():
+        if client.tracing and time.time() - last_trace_log_ts > TRACE_LOG_INTERVAL:
+            last_trace_log_ts = time.time()
+            for stage, (p50, p95, p99) in client.trace_stats.summary().items():
+                logging.info('Latency %-8s p50 %7.1f ms  p95 %7.1f ms  p99 %7.1f ms', stage, p50 * 1000, p95 * 1000, p99 * 1000)
+
         if client.last_ping_ts:
             if time.time() - client.last_ping_ts > PING_TIMEOUT:
                 logging.debug('Connection lost')
@@ -74,6 +103,8 @@ async def check_connection(session, client, stop_flag, reconnect_flag):
                 reconnect_flag.set()
         elif client.last_server_msg_ts and time.time() - client.last_server_msg_ts > MAX_MESSAGE_FRESHNESS:
             client.ping()
+        elif len(client.clock.samples) < CLOCK_SAMPLES or time.time() - client.clock.last_sample_ts > CLOCK_SYNC_INTERVAL:
+            client.ping()
 
         await asyncio.sleep(1)
 
@@ -90,7 +121,7 @@ async def connect(session, client, client_lock, stop_flag, reconnect_flag):
             client.on_connected()
 
             read_task = asyncio.create_task(read_socket(ws, codec, client.connection, client_lock, client))
-            write_task = asyncio.create_task(write_socket(ws, codec, client.connection, client_lock))
+            write_task = asyncio.create_task(write_socket(ws, codec, client, client_lock))
             wait_stop_task = asyncio.create_task(wait_stop_flag(stop_flag, ws))
             check_connection_task = asyncio.create_task(check_connection(session, client, stop_flag, reconnect_flag))
             await asyncio.gather(read_task, write_task, wait_stop_task, check_connection_task)
@@ -111,11 +142,7 @@ def load_state(filename):
             return json.load(f)
 
 
-async def async_main():
-    argparser = argparse.ArgumentParser()
-    argparser.add_argument('--new', default=False, action='store_true')
-    args = argparser.parse_args()
-
+async def async_main(args):
     game_id, player_id = None, None
 
     if not args.new:
@@ -154,12 +181,14 @@ async def async_main():
         # create client
         connection = Connection()
         client = Client(game_id, player_id, connection)
+        client.tracing = args.trace
+        client.publish_snapshots = True
         client_lock = Lock()
 
         stop_flag = Event()
         reconnect_flag = Event()
 
-        game_loop_thread = Thread(target=game_loop, args=(client, client_lock, stop_flag, reconnect_flag))
+        game_loop_thread = Thread(target=game_loop, args=(client, client_lock, stop_flag, reconnect_flag, args.fps))
         game_loop_thread.start()
 
         while True:
@@ -187,10 +216,92 @@ def sign(x):
         return 0
 
 
-def make_transparent(img, alpha):
-    img = img.copy()
-    img.set_alpha(alpha)
-    return img
+class FramePacer:
+    """ Starts frames at a steady rate whatever time they take. After a late frame the next ones
+        start right away to catch up, unless it's more than MAX_FRAME_DEBT frames behind. """
+
+    def __init__(self, fps=TARGET_FPS):
+        self.period = 1 / fps
+        self.next_ts = None
+
+    def wait(self):
+        now = time.perf_counter()
+        if self.next_ts is None or self.next_ts < now - MAX_FRAME_DEBT * self.period:
+            self.next_ts = now
+        if self.next_ts > now:
+            time.sleep(self.next_ts - now)
+        self.next_ts += self.period
+
+
+class FrameStats:
+    """ Frame rate, frame times and time taken by each stage of the last STATS_WINDOW frames. """
+
+    def __init__(self, window=STATS_WINDOW):
+        self.frame_ts = deque(maxlen=window)
+        self.stages = defaultdict(lambda: deque(maxlen=window)) # stage -> seconds, 'frame' for all of it
+        self.start_ts = self.mark_ts = time.perf_counter()
+
+    def begin(self):
+        self.start_ts = self.mark_ts = time.perf_counter()
+
+    def mark(self, stage):
+        """ The stage has just ended. """
+        now = time.perf_counter()
+        self.stages[stage].append(now - self.mark_ts)
+        self.mark_ts = now
+
+    def end(self):
+        now = time.perf_counter()
+        self.stages['frame'].append(now - self.start_ts)
+        self.frame_ts.append(now)
+
+    @property
+    def fps(self):
+        if len(self.frame_ts) < 2:
+            return 0
+        return (len(self.frame_ts) - 1) / (self.frame_ts[-1] - self.frame_ts[0])
+
+    def summary(self):
+        """ stage -> (p50, p99) seconds, the whole frame first. """
+        stages = sorted(self.stages, key=lambda stage: stage != 'frame')
+        return {stage: (percentile(self.stages[stage], 50), percentile(self.stages[stage], 99)) for stage in stages}
+
+
+class DisplayList:
+    """ Blits making up a frame, kept to find out what has changed by the next one. """
+
+    def __init__(self, origin=(0, 0)):
+        self.origin = origin # maze pixel at the top left corner of the screen
+        self.images = []
+        self.rects = []
+
+    def blit(self, image, pos):
+        self.images.append(image)
+        self.rects.append(image.get_rect(topleft=(round(pos[0] - self.origin[0]), round(pos[1] - self.origin[1]))))
+
+    def draw(self, canvas, area):
+        for index in area.collidelistall(self.rects):
+            canvas.blit(self.images[index], self.rects[index])
+
+    def diff(self, other):
+        """ Rects of the blits found in just one of the lists. Counted, as a translucent image
+            blitted twice to the same place looks different from one blitted once. """
+        items = Counter(zip(self.images, map(tuple, self.rects)))
+        other_items = Counter(zip(other.images, map(tuple, other.rects)))
+        return [pygame.Rect(rect) for image, rect in (items - other_items) + (other_items - items)]
+
+
+class WalkableCells:
+    """ Cells an arrow flies through freely, for one frame: gathers the occupied cells once
+        rather than on every lookup. """
+
+    def __init__(self, game):
+        self.maze = game.maze
+        self.occupied = game.occupied_cells
+
+    def __contains__(self, cell):
+        x, y = cell
+        return 0 <= x < self.maze.width and 0 <= y < self.maze.height and self.maze.get(x, y) == '.' and cell not in self.occupied
 
 
 class Animation:
@@ -250,8 +361,7 @@ class TeleportAnimation(Animation):
         self.end_pos = unit.pos
         self.start_time = time
         self.done = False
-        img = self.renderer.RESOURCES['teleport'][0]
-        self.images = [make_transparent(img, i*255/10) for i in range(11)]
+        self.images = self.renderer.SPRITES['teleport'][0] # fading in
         self.img_index = 0
 
     def update(self, time):
@@ -295,6 +405,8 @@ class Controller:
     def __init__(self):
         self.state = ControllerState.MOVE_CHAR
         self.aim = None
+        self.camera = (0, 0) # maze cell at the top left corner of the screen, see Renderer
+        self.show_stats = False
 
     def process_user_input(self, client, stop_flag):
         if not pygame.get_init():
@@ -362,24 +474,34 @@ class Controller:
                         else:
                             client.teleport(client.char.id, *self.aim)
                             self.state = ControllerState.MOVE_CHAR
+                elif event.key == K_F3:
+                    self.show_stats = not self.show_stats
                 elif event.key == ord('q'):
                     if os.path.exists('client.json'):
                         os.unlink('client.json')
                     stop_flag.set()
+            elif event.type == MOUSEBUTTONDOWN and event.button == 1:
+                if client.char and self.state == ControllerState.MOVE_CHAR:
+                    x, y = event.pos[0] // Renderer.CELL_SIZE + self.camera[0], event.pos[1] // Renderer.CELL_SIZE + self.camera[1]
+                    client.move_to(client.char.id, x, y)
 
 
 class Renderer:
     CELL_SIZE = 48
 
-    def __init__(self, client, controller):
-        self.client = client
+    def __init__(self, controller):
         self.controller = controller
-        self.SHADE = []
-        self.RESOURCES = defaultdict(list)
-        self.resources_map = {} # id -> img
+        self.stats = FrameStats()
+        self.stats_image = None
+        self.stats_image_ts = 0
+        self.font = None
+        self.SPRITES = {} # key -> frames, each a tuple of its variants, see atlas
+        self.RESOURCES = defaultdict(list) # key -> frames
+        self.resources_map = {} # (tile, x, y) -> img
+        self.autotile = AutotileIndex()
+        self.resources_decals = {} # (cell index, kind, direction) -> img
         self.resources_units = {} # id -> (left_img, right_img)
         self.resources_projectiles = {} # id -> (left_img, right_img, up_img, down_img)
-        self.resources_projectile_trails = {} # id -> (left_img, right_img, up_img, down_img)
         self.projectile_trails = defaultdict(lambda: deque(maxlen=PROJECTILE_TRAIL_BUFFER)) # id -> circular buffer
         self.unit_direction = defaultdict(int)
         self.subtile_xy = {} # id -> (x, y, smooth_flag) subtile coordinates, for smooth animation
@@ -387,38 +509,138 @@ class Renderer:
         self.prev_pos = {} # id -> (x, y)
         self.prev_effects = {} # id -> effects
         self.animations = defaultdict(dict) # id -> {anim_type: anim}
+        self.MARKERS = {}
+        self.static_layer = None # maze tiles, redrawn only where the maze changes
+        self.static_map = None # tile codes the static layer shows
+        self.fog = None # darkens what the player can't see well
+        self.fog_visibility = None # visibility the fog shows
+        self.prev_scene = DisplayList()
+        self.prev_overlay = DisplayList()
+        self.view_size = None # cells
+        self.camera = None # maze cell at the top left corner of the screen
+        self.prev_in_view = set() # ids of the entities drawn last frame
+        self.removed_entities = deque() # ids of the entities gone from the game, appended by the network thread
+
+    def entity_added(self, entity):
+        pass
+
+    def entity_removed(self, entity):
+        self.removed_entities.append(entity.id)
+
+    def evict_removed(self, game):
+        """ Forget what is kept about the entities gone from the game. The game being drawn
+            may predate the removal, then the entity is forgotten on a later frame. """
+        pending = []
+        while self.removed_entities:
+            id = self.removed_entities.popleft()
+            if id in game.entities:
+                pending.append(id)
+                continue
+            for cache in (self.resources_units, self.subtile_xy, self.projectile_trails, self.animations,
+                          self.prev_pos, self.prev_effects, self.unit_direction):
+                cache.pop(id, None)
+            self.prev_in_view.discard(id)
+        self.removed_entities.extend(pending)
 
     def load_resources(self):
-        for filename in glob.glob('./art/*.png'):
-            img = pygame.image.load(filename).convert_alpha()
-            key = os.path.splitext(os.path.split(filename)[-1])[0]
-            if '-' in key:
-                suffix = key.split('-')[-1]
-                try:
-                    suffix = int(suffix)
-                    key = key[:key.rfind('-')]
-                except ValueError:
-                    pass
-            self.RESOURCES[key].append(img)
-
-        for i in range(11):
-            shade = pygame.Surface((Renderer.CELL_SIZE, Renderer.CELL_SIZE), pygame.SRCALPHA)
-            shade.fill((0, 0, 0))
-            shade.set_alpha(int(255 / 11 * (11 - i)))
-            self.SHADE.append(shade.convert_alpha())
-
-        for projectile in ('arrow', ):
-            self.resources_projectiles[projectile] = []
-            self.resources_projectile_trails[projectile] = []
-            for res_img in self.RESOURCES[projectile]:
-                rotate = pygame.transform.rotate
-                res_images = (res_img, rotate(res_img, 180), rotate(res_img, 270), rotate(res_img, 90))
-                self.resources_projectiles[projectile].append(tuple(chain(res_images, (make_transparent(img, PROJECTILE_TRAIL_TRANSPARENCY) for img in res_images))))
-
-    def init(self):
+        image, index = atlas.load()
+        self.SPRITES = atlas.sprites(image.convert_alpha(), index)
+        for key, frames in self.SPRITES.items():
+            self.RESOURCES[key] = [variants[0] for variants in frames]
+        self.resources_projectiles['arrow'] = self.SPRITES['arrow']
+
+        marker = pygame.Surface((Renderer.CELL_SIZE, Renderer.CELL_SIZE), pygame.SRCALPHA)
+        pygame.draw.rect(marker, (0, 255, 0), marker.get_rect(), width=1)
+        self.MARKERS['char'] = marker
+        marker = pygame.Surface((Renderer.CELL_SIZE, Renderer.CELL_SIZE), pygame.SRCALPHA)
+        pygame.draw.circle(marker, (0, 255, 0), (Renderer.CELL_SIZE/2, Renderer.CELL_SIZE/2), Renderer.CELL_SIZE/2, width=1)
+        self.MARKERS['aim'] = marker
+
+        self.font = pygame.font.Font(None, 20)
+
+    def init(self, maze):
         pygame.init()
-        self.screen = pygame.display.set_mode((Renderer.CELL_SIZE * self.client.game.maze.width, Renderer.CELL_SIZE * self.client.game.maze.height))
+        self.view_size = (min(maze.width, VIEWPORT_WIDTH), min(maze.height, VIEWPORT_HEIGHT))
+        self.screen = pygame.display.set_mode((Renderer.CELL_SIZE * self.view_size[0], Renderer.CELL_SIZE * self.view_size[1]))
         self.load_resources()
+        self.static_layer = pygame.Surface(self.screen.get_size()).convert()
+
+    def tile_image(self, x, y):
+        tile = self.autotile.tile(x, y)
+        res_key = (tile, x, y)
+        if tile and res_key not in self.resources_map:
+            assert self.RESOURCES[tile], tile
+            self.resources_map[res_key] = random.choice(self.RESOURCES[tile])
+        return self.resources_map.get(res_key)
+
+    def view_cells(self, grid):
+        """ The part of a maze-sized grid under the camera. """
+        (cx, cy), (width, height) = self.camera, self.view_size
+        return [row[cx:cx + width] for row in grid[cy:cy + height]]
+
+    def in_view(self, x, y):
+        (cx, cy), (width, height) = self.camera, self.view_size
+        return cx - CULL_MARGIN <= x < cx + width + CULL_MARGIN and cy - CULL_MARGIN <= y < cy + height + CULL_MARGIN
+
+    def update_camera(self, maze, char):
+        """ Follow the char, scrolling when it gets closer than CAMERA_MARGIN to the edge.
+            Returns whether the camera has moved. """
+        width, height = self.view_size
+        cx, cy = self.camera or (0, 0)
+        if char:
+            if self.camera is None:
+                cx, cy = char.x - width // 2, char.y - height // 2
+            margin_x, margin_y = min(CAMERA_MARGIN, (width - 1) // 2), min(CAMERA_MARGIN, (height - 1) // 2)
+            cx = min(max(cx, char.x + margin_x + 1 - width), char.x - margin_x)
+            cy = min(max(cy, char.y + margin_y + 1 - height), char.y - margin_y)
+        cx, cy = min(max(cx, 0), maze.width - width), min(max(cy, 0), maze.height - height)
+        moved = (cx, cy) != self.camera
+        self.camera = self.controller.camera = (cx, cy)
+        return moved
+
+    def update_static_layer(self, maze):
+        """ Redraw the changed tiles in view. Returns the screen rects affected. """
+        self.autotile.update(maze)
+        cells = self.view_cells(self.autotile.rows)
+        if cells == self.static_map:
+            return []
+        CELL_SIZE = Renderer.CELL_SIZE
+        cx, cy = self.camera
+        rects = []
+        for y, x0, x1 in changed_spans(self.static_map, cells):
+            rect = pygame.Rect(CELL_SIZE * x0, CELL_SIZE * y, CELL_SIZE * (x1 - x0 + 1), CELL_SIZE)
+            self.static_layer.fill((0, 0, 0), rect)
+            for x in range(x0, x1 + 1):
+                if tile := self.tile_image(cx + x, cy + y):
+                    self.static_layer.blit(tile, (CELL_SIZE * x, CELL_SIZE * y))
+            rects.append(rect)
+        self.static_map = cells
+        return rects
+
+    def update_fog(self, visibility):
+        """ Rebuild the fog if the visibility in view has changed. Returns the screen rects affected. """
+        visibility = self.view_cells(visibility)
+        if visibility == self.fog_visibility:
+            return []
+        CELL_SIZE = Renderer.CELL_SIZE
+        rects = [pygame.Rect(CELL_SIZE * x0, CELL_SIZE * y, CELL_SIZE * (x1 - x0 + 1), CELL_SIZE)
+                 for y, x0, x1 in changed_spans(self.fog_visibility, visibility)]
+        width, height = len(visibility[0]), len(visibility)
+        pixels = bytearray(width * height * 4) # black, a pixel per cell
+        pixels[3::4] = bytes(FOG_ALPHA[int((v or 0) * 10)] for row in visibility for v in row)
+        cells = pygame.image.frombuffer(pixels, (width, height), 'RGBA')
+        self.fog = pygame.transform.scale(cells, (CELL_SIZE * width, CELL_SIZE * height)).convert_alpha()
+        self.fog_visibility = visibility
+        return rects
+
+    def compose(self, rect, scene, overlay):
+        """ Redraw a region of the screen from the static layer, the display lists and the fog. """
+        self.screen.set_clip(rect)
+        self.screen.blit(self.static_layer, rect, rect)
+        scene.draw(self.screen, rect)
+        self.screen.blit(self.fog, rect, rect)
+        overlay.draw(self.screen, rect)
+        self.screen.set_clip(None)
 
     # the lower, the eagerly drawn
     def draw_order(self, entity):
@@ -429,34 +651,59 @@ class Renderer:
         elif isinstance(entity, model.Projectile):
             return 20 if entity.speed else 5
 
-    def render(self):
-        client = self.client
+    def draw_stats(self):
+        lines = [f'{self.stats.fps:5.1f} FPS']
+        for stage, (p50, p99) in self.stats.summary().items():
+            lines.append(f'{stage:<8} {p50 * 1000:5.1f} {p99 * 1000:5.1f} ms')
+        images = [self.font.render(line, True, (0, 255, 0)) for line in lines]
+        image = pygame.Surface((max(image.get_width() for image in images) + 8, sum(image.get_height() for image in images) + 8))
+        y = 4
+        for line_image in images:
+            image.blit(line_image, (4, y))
+            y += line_image.get_height()
+        return image
+
+    def render(self, client):
+        """ Draw a frame of what the client knows, a ClientSnapshot if rendering alongside the network. """
         if not client.game:
             return
 
-        now = time.time() # local timer, todo: use server time
+        now = time.time() # local timer for animations
+        server_now = client.server_now() # projectiles are timed by the server clock
+        interpolated = client.interpolated_positions() # remote units, they move smoothly on their own
 
         CELL_SIZE = Renderer.CELL_SIZE
 
         if not self.screen:
-            self.init()
+            self.init(client.game.maze)
+        self.evict_removed(client.game)
+        walkable = None # gathered on the first arrow in flight
+
+        maze = client.game.maze
+        visibility = client.game.visibility[client.player_id]
+        if self.update_camera(maze, client.char):
+            self.static_map = self.fog_visibility = None # all of the screen is to be redrawn
+        origin = (CELL_SIZE * self.camera[0], CELL_SIZE * self.camera[1])
+        entities = [entity for entity in client.game.entities.values() if self.in_view(entity.x, entity.y)]
 
         # launch movement animation
-        for id, entity in client.game.entities.items():
-            if isinstance(entity, Unit):
+        for entity in entities:
+            id = entity.id
+            if isinstance(entity, Unit) and id in self.prev_in_view:
                 unit = entity
                 if id in self.prev_pos and entity.pos != self.prev_pos[id] or id in self.prev_effects and unit.effects.jump_tick != self.prev_effects[id].jump_tick:
-                    if id in self.prev_effects and unit.effects.jump_tick != self.prev_effects[id].jump_tick:
+                    if id in self.prev_effects and unit.effects.jump_tick != self.prev_effects[id].jump_tick and id not in interpolated:
                         self.animations[id][AnimationKind.MOVEMENT] = JumpAnimation(self, unit, now, self.prev_pos[id])
                     elif id in self.prev_effects and unit.effects.teleport_tick != self.prev_effects[id].teleport_tick:
                         self.animations[id][AnimationKind.TELEPORT] = TeleportAnimation(self, unit, now, self.prev_pos[id])
-                    else:
+                    elif id not in interpolated:
                         self.animations[id][AnimationKind.MOVEMENT] = WalkAnimation(self, unit, now, self.prev_pos[id])
                 if id in self.prev_effects and unit.effects.hit_tick != self.prev_effects[id].hit_tick:
                     self.animations[id][AnimationKind.TAKE_DAMAGE] = HitAnimation(self, unit, now)
             # TODO: projectiles too!
             self.prev_pos[id] = entity.pos
-            self.prev_effects[id] = entity.effects
+            self.prev_effects[id] = copy.copy(entity.effects) # copy, prediction changes effects in place
+        self.prev_in_view = set(entity.id for entity in entities)
 
         # tick animations
         for animations in self.animations.values():
@@ -466,80 +713,49 @@ class Renderer:
                 if animations[key].done:
                     del animations[key]
 
-        # fill background
-        background = pygame.Surface(self.screen.get_size())
-        background.fill((0, 0, 0))
-
-        # draw maze
-        maze = client.game.maze
-        for y in range(maze.height):
-            for x in range(maze.width):
-                visibility = client.game.get_visibility(client.player_id, x, y)
-                if not visibility:
-                    continue
-                cell = maze.get(x, y)
-                res_key = (cell, x, y)
-                if res_key not in self.resources_map:
-                    tile = None
-                    if cell == '.':
-                        tile = 'floor'
-                    elif cell == '+':
-                        tile = 'door-closed'
-                    elif cell in '-|':
-                        u = y > 0 and maze.get(x, y - 1) in '-|'
-                        d = y < maze.height - 1 and maze.get(x, y + 1) in '-|'
-                        l = x > 0 and maze.get(x - 1, y) in '-|'
-                        r = x < maze.width - 1 and maze.get(x + 1, y) in '-|'
-                        tile = 'wall' + {
-                            (False, False, False, False): '',
-                            (True,  True,  False, False): '-v',
-                            (True,  False, False, False): '-u',
-                            (False, True,  False, False): '-d',
-                            (False, False, True,  True ): '-h',
-                            (False, False, True,  False): '-l',
-                            (False, False, False, True ): '-r',
-                            (True,  False, True,  False): '-dr',
-                            (True,  False, False, True ): '-dl',
-                            (False, True,  True,  False): '-ur',
-                            (False, True,  False, True ): '-ul',
-                            (True,  True,  False, True ): '-vr',
-                            (True,  True,  True,  False): '-vl',
-                            (False, True,  True,  True ): '-hd',
-                            (True,  False, True,  True ): '-hu',
-                        }[(u, d, l, r)]
-                    if tile:
-                        assert self.RESOURCES[tile], tile
-                        res_img = random.choice(self.RESOURCES[tile])
-                        self.resources_map[res_key] = res_img
-                background.blit(self.resources_map[res_key], (CELL_SIZE*x, CELL_SIZE*y))
+        self.stats.mark('animate')
+        scene, overlay = DisplayList(origin), DisplayList(origin) # under and over the fog
 
         # bg animation effects
         for animations in self.animations.values():
             for animation in animations.values():
-                animation.draw_bg(background)
+                animation.draw_bg(scene)
+
+        # draw decals
+        for index, (kind, direction, tick) in maze.decals.items():
+            x, y = maze.decal_pos(index)
+            if self.in_view(x, y) and client.game.get_visibility(client.player_id, x, y) > 0.5:
+                res_key = (index, kind, direction)
+                if res_key not in self.resources_decals:
+                    if kind == ops.GRAVE_DECAL:
+                        self.resources_decals[res_key] = random.choice(self.RESOURCES['bones'])
+                    else:
+                        self.resources_decals[res_key] = random.choice(self.resources_projectiles['arrow'])[direction]
+                scene.blit(self.resources_decals[res_key], (CELL_SIZE * x, CELL_SIZE * y))
 
         # draw entities
-        for entity in sorted(client.game.entities.values(), key=self.draw_order):
+        for entity in sorted(entities, key=self.draw_order):
             if client.game.get_visibility(client.player_id, entity.x, entity.y) > 0.5:
                 if isinstance(entity, model.Unit):
                     unit = entity
                     if unit.id not in self.resources_units:
-                        res_index = hash((client.game_id, unit.id)) % len(self.RESOURCES['hero'])
-                        res_img = self.RESOURCES['hero'][res_index]
-                        self.resources_units[unit.id] = (res_img, pygame.transform.flip(res_img, True, False))
+                        res_index = hash((client.game_id, unit.id)) % len(self.SPRITES['hero'])
+                        self.resources_units[unit.id] = self.SPRITES['hero'][res_index] # left, right
                     if unit.direction == model.LEFT:
                         self.unit_direction[unit.id] = 0
                     elif unit.direction == model.RIGHT:
                         self.unit_direction[unit.id] = 1
                     x, y = CELL_SIZE * unit.x, CELL_SIZE * unit.y
-                    if unit.id in self.subtile_xy:
+                    if unit.id in interpolated:
+                        x, y = round(CELL_SIZE * interpolated[unit.id][0]), round(CELL_SIZE * interpolated[unit.id][1])
+                    elif unit.id in self.subtile_xy:
                         x += self.subtile_xy[unit.id][0]
                         y += self.subtile_xy[unit.id][1]
-                    background.blit(self.resources_units[unit.id][self.unit_direction[unit.id]], (x, y))
+                    scene.blit(self.resources_units[unit.id][self.unit_direction[unit.id]], (x, y))
                 elif isinstance(entity, model.Grave):
                     if entity.id not in self.resources_units:
                         self.resources_units[entity.id] = random.choice(self.RESOURCES['bones'])
-                    background.blit(self.resources_units[entity.id], (CELL_SIZE * entity.x, CELL_SIZE * entity.y))
+                    scene.blit(self.resources_units[entity.id], (CELL_SIZE * entity.x, CELL_SIZE * entity.y))
                 elif isinstance(entity, model.Projectile):
                     arrow = entity
                     if arrow.id not in self.resources_units:
@@ -553,9 +769,11 @@ class Renderer:
                             vv = math.hypot(vx, vy)
                             vx /= vv
                             vy /= vv
-                            x = round(arrow.start_x * CELL_SIZE + vx * arrow.speed * (now - arrow.start_time) * CELL_SIZE) - arrow.x * CELL_SIZE
-                            y = round(arrow.start_y * CELL_SIZE + vy * arrow.speed * (now - arrow.start_time) * CELL_SIZE) - arrow.y * CELL_SIZE
+                            x = round(arrow.start_x * CELL_SIZE + vx * arrow.speed * (server_now - arrow.start_time) * CELL_SIZE) - arrow.x * CELL_SIZE
+                            y = round(arrow.start_y * CELL_SIZE + vy * arrow.speed * (server_now - arrow.start_time) * CELL_SIZE) - arrow.y * CELL_SIZE
                             tx, ty = arrow.x + round(x / CELL_SIZE), arrow.y + round(y / CELL_SIZE)
+                            if walkable is None:
+                                walkable = WalkableCells(client.game)
                             def hit_test(ax, ay, x, y):
                                 while (ax, ay) != (x, y):
                                     if abs(ax - x) > abs(ay - y):
@@ -565,7 +783,7 @@ class Renderer:
                                     else:
                                         ax += 1 if ax < x else -1
                                         ay += 1 if ay < y else -1
-                                    if (ax, ay) not in client.game.maze.free_cells - client.game.occupied_cells:
+                                    if (ax, ay) not in walkable:
                                         return True
                                 return False
                             if (tx, ty) == (arrow.start_x, arrow.start_y) or not hit_test(arrow.x, arrow.y, tx, ty):
@@ -595,21 +813,15 @@ class Renderer:
 
                     for trail_xy in lerp_trail:
                         trail_img = self.resources_units[arrow.id][arrow.direction + 4]
-                        background.blit(trail_img, (trail_xy))
+                        scene.blit(trail_img, (trail_xy))
                     self.projectile_trails[arrow.id].append((x, y))
                     # render arrow
-                    background.blit(self.resources_units[arrow.id][arrow.direction], (x, y))
+                    scene.blit(self.resources_units[arrow.id][arrow.direction], (x, y))
 
         # fg animation effects
         for animations in self.animations.values():
             for animation in animations.values():
-                animation.draw_fg(background)
-
-        # shade
-        for y in range(maze.height):
-            for x in range(maze.width):
-                visibility = client.game.get_visibility(client.player_id, x, y) or 0
-                background.blit(self.SHADE[int(visibility * 10)], (CELL_SIZE*x, CELL_SIZE*y), special_flags=BLEND_ALPHA_SDL2)
+                animation.draw_fg(scene)
 
         # draw activity marker
         if self.controller.state == ControllerState.MOVE_CHAR:
@@ -619,41 +831,176 @@ class Renderer:
                 if char.id in self.subtile_xy:
                     x += self.subtile_xy[char.id][0]
                     y += self.subtile_xy[char.id][1]
-                pygame.draw.rect(background, (0, 255, 0), (x, y, CELL_SIZE, CELL_SIZE), width=1)
+                overlay.blit(self.MARKERS['char'], (x, y))
         elif self.controller.state in (ControllerState.AIM, ControllerState.TELEPORT):
             x = CELL_SIZE * self.controller.aim[0]
             y = CELL_SIZE * self.controller.aim[1]
-            pygame.draw.circle(background, (0, 255, 0), (x + CELL_SIZE/2, y + CELL_SIZE/2), CELL_SIZE/2, width=1)
-
-        # Blit everything to the screen
-        self.screen.blit(background, (0, 0))
-        pygame.display.flip()
+            overlay.blit(self.MARKERS['aim'], (x, y))
+
+        # frame stats
+        if self.controller.show_stats:
+            if now - self.stats_image_ts > STATS_OVERLAY_INTERVAL:
+                self.stats_image = self.draw_stats()
+                self.stats_image_ts = now
+            overlay.blit(self.stats_image, origin)
+        self.stats.mark('scene')
+
+        # redraw only what has changed since the last frame
+        dirty = self.update_static_layer(maze) + self.update_fog(visibility)
+        self.stats.mark('layers')
+        dirty += scene.diff(self.prev_scene) + overlay.diff(self.prev_overlay)
+        self.prev_scene, self.prev_overlay = scene, overlay
+        if len(dirty) > MAX_DIRTY_RECTS:
+            dirty = [self.screen.get_rect()]
+        for rect in dirty:
+            self.compose(rect, scene, overlay)
+        self.stats.mark('compose')
+        pygame.display.update(dirty)
+        self.stats.mark('present')
 
     def deinit(self):
         if pygame.get_init():
             pygame.quit()
 
 
-def game_loop(client, lock, stop_flag, reconnect_flag):
+def log_frame_stats(stats):
+    logging.info('Frames %.1f FPS', stats.fps)
+    for stage, (p50, p99) in stats.summary().items():
+        logging.info('Frames %-8s p50 %5.1f ms  p99 %5.1f ms', stage, p50 * 1000, p99 * 1000)
+
+
+def game_loop(client, lock, stop_flag, reconnect_flag, fps=TARGET_FPS):
     controller = Controller()
-    renderer = Renderer(client, controller)
+    renderer = Renderer(controller)
+    pacer = FramePacer(fps)
+    stats = renderer.stats
+    last_stats_log_ts = time.time()
+    with lock:
+        client.entity_listeners.append(renderer)
     try:
         while True:
             if not reconnect_flag.is_set() and stop_flag.is_set():
                 break
 
-            with lock:
-                renderer.render()
+            pacer.wait()
+            stats.begin()
+            with lock: # the network thread waits only for the input, which may predict
                 controller.process_user_input(client, stop_flag)
+                client.publish() # the inputs of the frame, if any were predicted
+            stats.mark('input')
+            if snapshot := client.snapshot: # published by the network thread, read without the lock
+                renderer.render(snapshot)
+            stats.end()
+
+            if time.time() - last_stats_log_ts > STATS_LOG_INTERVAL:
+                last_stats_log_ts = time.time()
+                log_frame_stats(stats)
+    finally:
+        with lock:
+            client.entity_listeners.remove(renderer)
+        renderer.deinit()
 
-            time.sleep(1 / 25)
+
+def synthetic_game(width, height, units):
+    """ A generated maze with the player's char and bots scattered over it. """
+    game = model.Game()
+    game.maze = model.Maze(width, height)
+    ops.MazeOp(game.maze).generate()
+    player = ops.GameOp(game).add_player('bench')
+    cells = list(game.maze.free_cells)
+    random.shuffle(cells)
+    for i, (x, y) in enumerate(cells[:max(units, 1)]):
+        ops.GameOp(game).add_entity(Unit(x=x, y=y, hp=1, player_id=player.id if i == 0 else 0))
+    char = game.units_by_player[player.id][0]
+    ops.GameOp(game).update_visibility(player.id, char.x, char.y)
+    return game, player.id
+
+
+def recorded_game(filename, game_id=None):
+    """ A game of a server checkpoint, see Server.save, with the player owning the first unit. """
+    with open(filename) as f:
+        games = Codec(auto_register=True, globals=globals()).decode(f.read())['games']
+    game = games[game_id] if game_id is not None else next(iter(games.values()))
+    return game, next(unit.player_id for unit in game.units if unit.player_id)
+
+
+def wander(game):
+    """ Step every unit to a random free cell next to it, if there is one. The visibility
+        is left as it is, recomputing it is the server's work rather than the renderer's. """
+    occupied = game.occupied_cells
+    for unit in list(game.units):
+        x, y = unit.x + random.randint(-1, 1), unit.y + random.randint(-1, 1)
+        if game.maze.get(x, y) == '.' and (x, y) not in occupied:
+            occupied.discard(unit.pos)
+            ops.EntityOp(unit).move(x, y)
+            occupied.add((x, y))
+
+
+def fire_arrows(game, count, renderer):
+    """ Replace the arrows in flight by count new ones, fired by random units. """
+    for arrow in [entity for entity in game.entities.values() if isinstance(entity, Projectile)]:
+        ops.GameOp(game).remove_entity(arrow)
+        renderer.entity_removed(arrow)
+    units = list(game.units)
+    for _ in range(count):
+        unit = random.choice(units)
+        dx, dy = random.choice(((-1, 0), (1, 0), (0, -1), (0, 1)))
+        ops.GameOp(game).add_entity(Projectile(speed=BENCH_ARROW_SPEED, start_x=unit.x, start_y=unit.y,
+                                               target_x=unit.x + dx, target_y=unit.y + dy, start_time=time.time()))
+
+
+def bench(args):
+    """ Render frames of a game offscreen as fast as possible and print the time they take. """
+    os.environ['SDL_VIDEODRIVER'] = 'dummy'
+    if args.state:
+        game, player_id = recorded_game(args.state, args.game_id)
+    else:
+        game, player_id = synthetic_game(*args.maze_size, args.units)
+    client = Client(None, player_id, Connection())
+    client.game = game
+    renderer = Renderer(Controller())
+    try:
+        renderer.render(client) # loads everything, not to be counted
+        renderer.stats = stats = FrameStats(args.bench)
+        for frame in range(args.bench):
+            if frame % BENCH_TICK_FRAMES == 0:
+                wander(game)
+                game.next_tick()
+            if frame % BENCH_ARROW_FRAMES == 0:
+                fire_arrows(game, args.arrows, renderer)
+            stats.begin()
+            renderer.render(client)
+            stats.end()
     finally:
         renderer.deinit()
 
+    frame_times = stats.stages['frame']
+    print(f'{len(frame_times)} frames, maze {game.maze.width}x{game.maze.height}, '
+          f'{sum(1 for _ in game.units)} units, {args.arrows} arrows: {len(frame_times) / sum(frame_times):.1f} FPS')
+    for stage, (p50, p99) in stats.summary().items():
+        print(f'{stage:<8} p50 {p50 * 1000:6.2f} ms  p99 {p99 * 1000:6.2f} ms')
+
 
 def main():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('--new', default=False, action='store_true')
+    argparser.add_argument('--trace', default=False, action='store_true', help='trace requests and log latency breakdown')
+    argparser.add_argument('--fps', default=TARGET_FPS, type=int, help='target frame rate')
+    argparser.add_argument('--bench', nargs='?', const=BENCH_FRAMES, type=int, metavar='FRAMES',
+                           help='render frames headless, without a server, and report the time they take')
+    argparser.add_argument('--maze-size', default=BENCH_MAZE_SIZE, nargs=2, type=int, metavar=('WIDTH', 'HEIGHT'), help='of the benchmark game')
+    argparser.add_argument('--units', default=BENCH_UNITS, type=int, help='in the benchmark game')
+    argparser.add_argument('--arrows', default=BENCH_ARROWS, type=int, help='in flight in the benchmark game')
+    argparser.add_argument('--state', help='benchmark a game of this server checkpoint rather than a generated one')
+    argparser.add_argument('--game-id', type=int, help='of the game in the checkpoint, the first one by default')
+    args = argparser.parse_args()
+
+    if args.bench:
+        bench(args)
+        return
+
     logging.basicConfig(level=logging.DEBUG)
-    asyncio.run(async_main()) #, debug=True)
+    asyncio.run(async_main(args)) #, debug=True)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,54 @@
+#! /usr/bin/python3
+
+import argparse
+import logging
+import time
+
+from messaging import Codec
+from protocol import *
+from server import Server
+from util import percentile
+
+
+def main():
+    argparser = argparse.ArgumentParser(description='Run a crowded game in-process and measure server tick cost')
+    argparser.add_argument('--players', type=int, default=4)
+    argparser.add_argument('--bots', type=int, default=200)
+    argparser.add_argument('--maze-size', type=int, nargs=2, default=(60, 40), metavar=('WIDTH', 'HEIGHT'))
+    argparser.add_argument('--ticks', type=int, default=200)
+    args = argparser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    server = Server()
+    codec = Codec(auto_register=True)
+
+    response = server.serve(CreateGameRequest('player1', *args.maze_size))
+    game_id = response.game_id
+    player_ids = [response.player_id]
+    for i in range(1, args.players):
+        player_ids.append(server.serve(JoinGameRequest(game_id=game_id, player_name=f'player{i + 1}')).player_id)
+    server.add_bots(game_id, args.bots)
+
+    simulate_times, broadcast_times, frame_bytes = [], [], []
+    for _ in range(args.ticks):
+        start = time.perf_counter()
+        server.simulate(game_id)
+        simulate_times.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        game = server.get_game(game_id)
+        for player_id in player_ids:
+            frame_bytes.append(len(codec.encode(GetGameResponse(game))))
+        server.next_tick(game_id)
+        broadcast_times.append(time.perf_counter() - start)
+
+    game = server.get_game(game_id)
+    print(f'maze {game.maze.width}x{game.maze.height}, {len(game.entities)} entities after {args.ticks} ticks')
+    for name, values in (('simulate', simulate_times), ('broadcast', broadcast_times)):
+        print(f'{name:10} p50 {percentile(values, 50) * 1000:8.3f} ms  p99 {percentile(values, 99) * 1000:8.3f} ms')
+    print(f'frame size p50 {percentile(frame_bytes, 50)} bytes')
+
+
+if __name__ == '__main__':
+    main()
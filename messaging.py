@@ -24,9 +24,9 @@ class Codec:
             return {self._encode_key(k): self._encode(v) for k, v in obj.items()}
         else:
             obj_type = type(obj)
-            if obj_type not in self._types and self._auto_register:
+            if obj_type not in self._rev and self._auto_register:
                 self.register(obj_type, id=obj_type.__name__)
-            return {'__message': self._rev[obj_type], '__data': self._encode(obj.__dict__)}
+            return {'__message': self._rev[obj_type], '__data': self._encode(util.object_state(obj))}
 
     def encode(self, message):
         return json.dumps(self._encode(message))
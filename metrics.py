@@ -0,0 +1,105 @@
+import bisect
+
+
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+METRICS_PREFIX = 'figack_'
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Gauge:
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def percentile(self, p):
+        """ Upper bound of the bucket holding the p-th percentile. """
+        if not self.count:
+            return 0
+        rank = self.count * p / 100
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+class Metrics:
+    """ Registry of named metrics. A metric is identified by its name and labels;
+        callers on hot paths are expected to keep the returned object
+        rather than look it up every time. """
+
+    def __init__(self):
+        self._metrics = {}  # (name, ((label, value), ...)) -> metric
+
+    def _get(self, metric_class, name, labels, *args):
+        key = (name, tuple(sorted(labels.items())))
+        if key not in self._metrics:
+            self._metrics[key] = metric_class(*args)
+        return self._metrics[key]
+
+    def counter(self, name, **labels):
+        return self._get(Counter, name, labels)
+
+    def gauge(self, name, **labels):
+        return self._get(Gauge, name, labels)
+
+    def histogram(self, name, buckets=LATENCY_BUCKETS, **labels):
+        return self._get(Histogram, name, labels, buckets)
+
+    def items(self):
+        """ ((name, labels), metric) pairs, sorted by name. """
+        return sorted(self._metrics.items(), key=lambda item: item[0])
+
+
+def _format_labels(labels, **extra):
+    labels = list(labels) + list(extra.items())
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels) + '}'
+
+
+def expose(*registries):
+    """ Text exposition format understood by Prometheus. """
+    lines = []
+    typed = set()
+    for registry in registries:
+        for (name, labels), metric in registry.items():
+            name = METRICS_PREFIX + name
+            if name not in typed:
+                lines.append(f'# TYPE {name} {type(metric).__name__.lower()}')
+                typed.add(name)
+            if isinstance(metric, Histogram):
+                cumulative = 0
+                for bound, count in zip(metric.buckets, metric.counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{_format_labels(labels, le=bound)} {cumulative}')
+                lines.append(f'{name}_bucket{_format_labels(labels, le="+Inf")} {metric.count}')
+                lines.append(f'{name}_sum{_format_labels(labels)} {metric.sum}')
+                lines.append(f'{name}_count{_format_labels(labels)} {metric.count}')
+            else:
+                lines.append(f'{name}{_format_labels(labels)} {metric.value}')
+    return '\n'.join(lines) + '\n'
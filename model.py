@@ -8,6 +8,9 @@ class Maze:
         else:
             # assert width and height
             self.map = [[' '] * width for _ in range(height)]
+        self.revision = 0  # bumped on every change of the cells, see MazeOp
+        self.local_changes = []  # cells the client has changed ahead of the server, see Client.predict
+        self.decals = {}  # y * width + x -> [kind, direction, tick], oldest first; int key because of json
 
     @property
     def height(self):
@@ -20,6 +23,9 @@ class Maze:
     def get(self, x, y):
         return self.map[y][x]
 
+    def decal_pos(self, index):
+        return (index % self.width, index // self.width)
+
     def set(self, x, y, v):
         self.map[y][x] = v
 
@@ -29,6 +35,8 @@ class Maze:
 
 
 class Effects:
+    __slots__ = ('hit_tick', 'jump_tick', 'teleport_tick')
+
     def __init__(self):
         self.hit_tick = None
         self.jump_tick = None
@@ -38,7 +46,11 @@ class Effects:
 LEFT, RIGHT, UP, DOWN = range(4)
 
 
+# entities may be counted in tens of thousands, so they are kept in __slots__;
+# use util.object_state() rather than __dict__ to get at their attributes
 class MazeEntity:
+    __slots__ = ('id', 'x', 'y', 'opaque', 'effects', 'direction')
+
     def __init__(self, id=0, x=0, y=0, opaque=False, effects=None, direction=LEFT):
         self.id = id
         self.x = x
@@ -53,16 +65,21 @@ class MazeEntity:
 
 
 class Grave(MazeEntity):
+    __slots__ = ()
+
     def __init__(self, id=0, x=0, y=0):
         super().__init__(id=id, x=x, y=y)
 
 
 class Unit(MazeEntity):
+    __slots__ = ('hp', 'damage', 'player_id', 'action_ticks')
+
     def __init__(self, id=0, x=0, y=0, hp=0, damage=0, player_id=0):
         super().__init__(id=id, x=x, y=y, opaque=True)
         self.hp = hp
         self.damage = damage
         self.player_id = player_id
+        self.action_ticks = {}  # action -> tick it was last taken at, for the cooldowns
 
     @property
     def dead(self):
@@ -70,6 +87,8 @@ class Unit(MazeEntity):
 
 
 class Projectile(MazeEntity):
+    __slots__ = ('damage', 'speed', 'start_x', 'start_y', 'target_x', 'target_y', 'start_time')
+
     def __init__(self, damage=0, speed=0, start_x=0, start_y=0, target_x=0, target_y=0, start_time=0):
         super().__init__(x=start_x, y=start_y)
         self.damage = damage
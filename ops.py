@@ -1,4 +1,4 @@
-from copy import deepcopy
+from copy import copy, deepcopy
 import logging
 import math
 import random
@@ -8,6 +8,21 @@ from util import *
 
 
 VISIBILITY_RADIUS = 10
+MAX_JUMP_DISTANCE = 2
+MAX_DECALS = 256
+DECAL_TTL = None  # in ticks, None to keep decals until evicted by MAX_DECALS
+TICK_INTERVAL = 0.25  # seconds, the server ticks on this cadence whatever the clients send
+
+# cooldowns, in ticks since Unit.action_ticks of the action
+MOVE_COOLDOWN = 1
+MELEE_COOLDOWN = 2
+FIRE_COOLDOWN = 4
+JUMP_COOLDOWN = 4
+TELEPORT_COOLDOWN = 10
+COOLDOWNS = {'move': MOVE_COOLDOWN, 'melee': MELEE_COOLDOWN, 'fire': FIRE_COOLDOWN, 'jump': JUMP_COOLDOWN, 'teleport': TELEPORT_COOLDOWN}
+
+GRAVE_DECAL = 'grave'
+ARROW_DECAL = 'arrow'
 
 
 class GameOp:
@@ -20,9 +35,9 @@ class GameOp:
         self._game.visibility[player.id] = [[0] * self._game.maze.width for _ in range(self._game.maze.height)] # 0..1
         return player
 
-    def init(self):
-        width = random.randint(10, 20)
-        height = random.randint(10, 15)
+    def init(self, width=None, height=None):
+        width = width or random.randint(10, 20)
+        height = height or random.randint(10, 15)
         self._game.maze = Maze(width, height)
 
     def spawn_unit(self, unit):
@@ -38,7 +53,61 @@ class GameOp:
     def remove_entity(self, entity):
         del self._game.entities[entity.id]
 
-    def update_from(self, game):
+    @property
+    def walkable_cells(self):
+        return self._game.maze.free_cells - self._game.occupied_cells
+
+    # validation shared by the server and the client prediction
+    def can_move(self, unit, x, y, tick):
+        return UnitOp(unit).ready('move', tick) and abs(unit.x - x) <= 1 and abs(unit.y - y) <= 1 and (x, y) in self.walkable_cells
+
+    def can_jump(self, unit, x, y, tick):
+        return UnitOp(unit).ready('jump', tick) and abs(unit.x - x) <= MAX_JUMP_DISTANCE and abs(unit.y - y) <= MAX_JUMP_DISTANCE
+
+    def can_open(self, unit, x, y):
+        return abs(unit.x - x) <= 1 and abs(unit.y - y) <= 1 and self._game.maze.get(x, y) == '+'
+
+    def hit(self, target, damage):
+        UnitOp(target).take_damage(damage, self._game.tick)
+        if target.dead:
+            self.retire(target, GRAVE_DECAL)
+
+    def retire(self, entity, decal_kind):
+        """ Replace an entity which won't act anymore with a decal on its cell. """
+        MazeOp(self._game.maze).add_decal(entity.x, entity.y, decal_kind, entity.direction, self._game.tick)
+        self.remove_entity(entity)
+
+    def retire_spent(self):
+        """ Fold graves and stopped projectiles into the maze decals. """
+        for entity in list(self._game.entities.values()):
+            if isinstance(entity, Grave):
+                self.retire(entity, GRAVE_DECAL)
+            elif isinstance(entity, Projectile) and not entity.speed:
+                self.retire(entity, ARROW_DECAL)
+
+    def copy(self, player_id=None):
+        """ Copy sharing nothing that is changed in place, way cheaper than deepcopy.
+            Given player_id, the visibility of the other players is left out. """
+        game = copy(self._game)
+        game.maze = copy(self._game.maze)
+        game.maze.map = [row[:] for row in self._game.maze.map]
+        game.maze.decals = dict(self._game.maze.decals)
+        game.maze.local_changes = list(self._game.maze.local_changes)
+        game.entities = {}
+        for id, entity in self._game.entities.items():
+            entity = copy(entity)
+            entity.effects = copy(entity.effects)
+            if isinstance(entity, Unit):
+                entity.action_ticks = dict(entity.action_ticks)
+            game.entities[id] = entity
+        game.players = {id: copy(player) for id, player in self._game.players.items()}
+        game.visibility = {id: [row[:] for row in grid] for id, grid in self._game.visibility.items()
+                           if player_id is None or id == player_id}
+        return game
+
+    def update_from(self, game, listener=None):
+        """ listener.entity_added(entity) and listener.entity_removed(entity) are called
+            for the entities which have appeared or disappeared. """
         class dict_proxy:
             def __init__(self, d):
                 self.d = d
@@ -54,7 +123,7 @@ class GameOp:
                 self.l.clear()
                 self.l.extend(other)
 
-        def update_dict(dest, source, op_class):
+        def update_dict(dest, source, op_class, listener=None):
             # existing
             removed = []
             for id, thing in dest.items():
@@ -66,14 +135,19 @@ class GameOp:
             # new
             for id in set(source.keys()) - set(dest.keys()):
                 dest[id] = source[id]
+                if listener:
+                    listener.entity_added(dest[id])
 
             # removed
             for id in removed:
+                if listener:
+                    listener.entity_removed(dest[id])
                 del dest[id]
 
+        self._game.tick = game.tick
         MazeOp(self._game.maze).update_from(game.maze)
         update_dict(self._game.players, game.players, PlayerOp)
-        update_dict(self._game.entities, game.entities, EntityOp)
+        update_dict(self._game.entities, game.entities, EntityOp, listener)
         update_dict(self._game.visibility, game.visibility, list_proxy)
 
     def update_visibility(self, player_id, x, y):
@@ -91,6 +165,7 @@ class GameOp:
 
         # move projectiles
         killed = []
+        spent = []
         for entity in self._game.entities.values():
             if isinstance(entity, Projectile):
                 arrow = entity
@@ -114,18 +189,20 @@ class GameOp:
                         if target:
                             EntityOp(arrow).move(ax, ay)
                             UnitOp(target).take_damage(arrow.damage, self._game.tick)
-                            if target.dead:
+                            if target.dead and target not in killed:
                                 killed.append(target)
                         # we're at opaque cell, so stop flying anyway
                         arrow.speed = 0
+                        spent.append(arrow)
                         game_changed = True
                         break
 
+        # arrows first, a grave on the same cell takes their place
+        for arrow in spent:
+            self.retire(arrow, ARROW_DECAL)
+
         for target in killed:
-            UnitOp(target).take_damage(arrow.damage, self._game.tick)
-            if target.dead: # repetition; not good
-                self.add_entity(Grave(x=target.x, y=target.y))
-                self.remove_entity(target)
+            self.retire(target, GRAVE_DECAL)
 
         return game_changed
 
@@ -161,6 +238,15 @@ class UnitOp:
     def update_from(self, unit):
         object_update_from(self._unit, unit)
 
+    def ready(self, action, tick):
+        """ Whether the cooldown of the action is over by tick. """
+        last_tick = self._unit.action_ticks.get(action)
+        return last_tick is None or tick >= last_tick + COOLDOWNS[action]
+
+    def act(self, action, tick):
+        """ Start the cooldown of the action. """
+        self._unit.action_ticks[action] = tick
+
     def jump(self, x, y, tick, walkable_cells):
         if x < self._unit.x:
             self._unit.direction = LEFT
@@ -209,6 +295,25 @@ class MazeOp:
 
     def open_door(self, x, y):
         self._maze.set(x, y, '.')
+        self._maze.revision += 1
+
+    def add_decal(self, x, y, kind, direction, tick):
+        decals = self._maze.decals
+        index = y * self._maze.width + x
+        decals.pop(index, None)  # re-insert, so the dict stays ordered by age
+        decals[index] = [kind, direction, tick]
+        while len(decals) > MAX_DECALS:
+            del decals[next(iter(decals))]
+
+    def expire_decals(self, tick, ttl=DECAL_TTL):
+        if ttl is None:
+            return False
+        decals = self._maze.decals
+        expired = False
+        while decals and next(iter(decals.values()))[2] + ttl <= tick:
+            del decals[next(iter(decals))]
+            expired = True
+        return expired
 
     def generate(self):
         maze = self._maze
@@ -298,6 +403,8 @@ class MazeOp:
             else:
                 maze.set(x, y, '-')
 
+        maze.revision += 1
+
         logging.debug('generated maze: \n%s', '\n'.join(''.join(row) for row in maze.map))
 
 
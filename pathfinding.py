@@ -0,0 +1,112 @@
+from collections import deque
+import heapq
+
+
+MAX_DISTANCE_FIELDS = 64
+UNREACHABLE = -1
+
+NEIGHBOURS = [(-1, 0), (1, 0), (0, -1), (0, 1), (-1, -1), (1, -1), (-1, 1), (1, 1)]
+
+
+class Pathfinder:
+    """ Path queries over the maze grid. Units may step to any of the 8 adjacent cells,
+        so every step costs 1 and Chebyshev distance is an exact lower bound.
+        Everything cached here is dropped as soon as the maze revision changes. """
+
+    def __init__(self, maze):
+        self._maze = maze
+        self._revision = None
+        self._walkable = None
+        self._fields = {}  # target -> flat distance list, oldest first
+
+    def _sync(self):
+        if self._revision != self._maze.revision or self._walkable is None:
+            self._revision = self._maze.revision
+            self._walkable = self._maze.free_cells
+            self._fields.clear()
+
+    @property
+    def walkable(self):
+        self._sync()
+        return self._walkable
+
+    def distance_field(self, target):
+        """ BFS distances to target from every cell, cached per target.
+            Shared by all units chasing the same target. """
+        self._sync()
+        field = self._fields.pop(target, None)
+        if field is None:
+            field = self._build_field(target)
+            if len(self._fields) >= MAX_DISTANCE_FIELDS:
+                del self._fields[next(iter(self._fields))]
+        self._fields[target] = field
+        return field
+
+    def distance(self, start, target):
+        return self.distance_field(target)[start[1] * self._maze.width + start[0]]
+
+    def _build_field(self, target):
+        width = self._maze.width
+        field = [UNREACHABLE] * (width * self._maze.height)
+        field[target[1] * width + target[0]] = 0
+        queue = deque([target])
+        while queue:
+            x, y = queue.popleft()
+            dist = field[y * width + x] + 1
+            for dx, dy in NEIGHBOURS:
+                cell = (x + dx, y + dy)
+                if cell in self._walkable and field[cell[1] * width + cell[0]] == UNREACHABLE:
+                    field[cell[1] * width + cell[0]] = dist
+                    queue.append(cell)
+        return field
+
+    def next_step(self, start, target, blocked=()):
+        """ Best adjacent cell towards target according to its distance field,
+            or None if there is no way to get closer right now. """
+        field = self.distance_field(target)
+        width = self._maze.width
+        best, best_dist = None, field[start[1] * width + start[0]]
+        if best_dist == UNREACHABLE:
+            return None
+        for dx, dy in NEIGHBOURS:
+            cell = (start[0] + dx, start[1] + dy)
+            if cell not in self._walkable or cell in blocked:
+                continue
+            dist = field[cell[1] * width + cell[0]]
+            if dist != UNREACHABLE and dist < best_dist:
+                best, best_dist = cell, dist
+        return best
+
+    def find_path(self, start, goal, blocked=()):
+        """ A* point query. Returns the list of cells to step through (start excluded),
+            or None if goal is unreachable. """
+        self._sync()
+        if goal not in self._walkable or goal in blocked:
+            return None
+
+        def heuristic(cell):
+            return max(abs(cell[0] - goal[0]), abs(cell[1] - goal[1]))
+
+        came_from = {start: None}
+        cost = {start: 0}
+        frontier = [(heuristic(start), 0, start)]
+        while frontier:
+            _, g, cell = heapq.heappop(frontier)
+            if cell == goal:
+                path = []
+                while cell != start:
+                    path.append(cell)
+                    cell = came_from[cell]
+                path.reverse()
+                return path
+            if g > cost[cell]:
+                continue
+            for dx, dy in NEIGHBOURS:
+                next_cell = (cell[0] + dx, cell[1] + dy)
+                if next_cell not in self._walkable or next_cell in blocked:
+                    continue
+                if next_cell not in cost or g + 1 < cost[next_cell]:
+                    cost[next_cell] = g + 1
+                    came_from[next_cell] = cell
+                    heapq.heappush(frontier, (g + 1 + heuristic(next_cell), g + 1, next_cell))
+        return None
@@ -0,0 +1,101 @@
+from collections import Counter
+import contextlib
+import cProfile
+import io
+import marshal
+import pstats
+import sys
+import threading
+import time
+
+
+CPROFILE = 'cprofile'
+SAMPLE = 'sample'
+MODES = (CPROFILE, SAMPLE)
+SAMPLE_INTERVAL = 0.005
+MAX_PSTATS_LINES = 60
+
+
+class Profiler:
+    """ On-demand profiling of a live server. While inactive the only cost for
+        the server is checking the active flag. Profiling may be limited to
+        one game, then only Server.serve and Server.simulate calls for that
+        game are captured. """
+
+    def __init__(self):
+        self.active = False
+        self.mode = None
+        self.game_id = None
+        self._profile = None
+        self._depth = 0
+        self._stacks = None
+        self._sampler = None
+        self._thread_id = None
+
+    def start(self, mode=CPROFILE, game_id=None):
+        assert not self.active
+        assert mode in MODES
+        self.mode = mode
+        self.game_id = game_id
+        self._depth = 0
+        self._thread_id = threading.get_ident()
+        if mode == CPROFILE:
+            self._profile = cProfile.Profile()
+            if game_id is None:
+                self._profile.enable()
+        else:
+            self._stacks = Counter()
+            self._sampler = threading.Thread(target=self._sample, daemon=True)
+        self.active = True
+        if self._sampler:
+            self._sampler.start()
+
+    def stop(self, raw=False):
+        """ Collapsed stacks for sampling, pstats text or raw pstats dump for cProfile. """
+        assert self.active
+        self.active = False
+        if self.mode == CPROFILE:
+            self._profile.disable()
+            if raw:
+                self._profile.create_stats()
+                return marshal.dumps(self._profile.stats)
+            out = io.StringIO()
+            pstats.Stats(self._profile, stream=out).sort_stats('cumulative').print_stats(MAX_PSTATS_LINES)
+            return out.getvalue()
+        else:
+            self._sampler.join()
+            self._sampler = None
+            return ''.join(f'{stack} {count}\n' for stack, count in self._stacks.most_common())
+
+    @contextlib.contextmanager
+    def capture(self, game_id):
+        entered = self._enter(game_id)
+        try:
+            yield
+        finally:
+            if entered:
+                self._exit()
+
+    def _enter(self, game_id):
+        if self.game_id is None or game_id != self.game_id:
+            return False
+        self._depth += 1
+        if self._depth == 1 and self.mode == CPROFILE:
+            self._profile.enable()
+        return True
+
+    def _exit(self):
+        self._depth -= 1
+        if not self._depth and self.mode == CPROFILE:
+            self._profile.disable()
+
+    def _sample(self):
+        while self.active:
+            frame = sys._current_frames().get(self._thread_id)
+            if frame and (self.game_id is None or self._depth):
+                stack = []
+                while frame:
+                    stack.append(f'{frame.f_code.co_filename}:{frame.f_code.co_name}')
+                    frame = frame.f_back
+                self._stacks[';'.join(reversed(stack))] += 1
+            time.sleep(SAMPLE_INTERVAL)
@@ -2,8 +2,10 @@ from model import *
 
 
 class CreateGameRequest:
-    def __init__(self, player_name=None):
+    def __init__(self, player_name=None, maze_width=None, maze_height=None):
         self.player_name = player_name
+        self.maze_width = maze_width  # random if not set
+        self.maze_height = maze_height
 
 
 class CreateGameResponse:
@@ -30,17 +32,20 @@ class GetGameRequest:
 
 
 class GetGameResponse:
-    def __init__(self, game=None):
+    def __init__(self, game=None, ack_seq=None, server_time=None):
         self.game = game
+        self.ack_seq = ack_seq  # seq of the last input of the receiving player applied to the game
+        self.server_time = server_time
 
 
 class MoveCharRequest:
-    def __init__(self, game_id=None, player_id=None, unit_id=None, x=None, y=None):
+    def __init__(self, game_id=None, player_id=None, unit_id=None, x=None, y=None, seq=None):
         self.game_id = game_id
         self.player_id = player_id
         self.unit_id = unit_id
         self.x = x
         self.y = y
+        self.seq = seq
 
 
 class AttackRequest:
@@ -53,12 +58,13 @@ class AttackRequest:
 
 
 class OpenRequest:
-    def __init__(self, game_id=None, player_id=None, unit_id=None, x=None, y=None):
+    def __init__(self, game_id=None, player_id=None, unit_id=None, x=None, y=None, seq=None):
         self.game_id = game_id
         self.player_id = player_id
         self.unit_id = unit_id
         self.x = x
         self.y = y
+        self.seq = seq
 
 
 class FireRequest:
@@ -71,22 +77,25 @@ class FireRequest:
 
 
 class PingRequest:
-    def __init__(self):
-        pass
+    def __init__(self, client_time=None, rtt=None):
+        self.client_time = client_time
+        self.rtt = rtt  # last one measured by the client
 
 
 class PingResponse:
-    def __init__(self, server_time=None):
+    def __init__(self, server_time=None, client_time=None):
         self.server_time = server_time
+        self.client_time = client_time  # echoed from the request
 
 
 class JumpRequest:
-    def __init__(self, game_id=None, player_id=None, unit_id=None, x=None, y=None):
+    def __init__(self, game_id=None, player_id=None, unit_id=None, x=None, y=None, seq=None):
         self.game_id = game_id
         self.player_id = player_id
         self.unit_id = unit_id
         self.x = x
         self.y = y
+        self.seq = seq
 
 
 class TeleportRequest:
@@ -96,3 +105,46 @@ class TeleportRequest:
         self.unit_id = unit_id
         self.x = x
         self.y = y
+
+
+class MoveToRequest:
+    def __init__(self, game_id=None, player_id=None, unit_id=None, x=None, y=None):
+        self.game_id = game_id
+        self.player_id = player_id
+        self.unit_id = unit_id
+        self.x = x
+        self.y = y
+
+
+class BatchRequest:
+    def __init__(self, requests=None):
+        self.requests = requests or []
+
+
+class BatchResponse:
+    def __init__(self, responses=None):
+        self.responses = responses or []
+
+
+class TracedRequest:
+    def __init__(self, trace_id=None, client_time=None, request=None):
+        self.trace_id = trace_id
+        self.client_time = client_time
+        self.received_at = None  # set by the server on arrival
+        self.request = request
+
+
+class TracedResponse:
+    def __init__(self, trace_id=None, client_time=None, server_time=None, timings=None, response=None):
+        self.trace_id = trace_id
+        self.client_time = client_time
+        self.server_time = server_time
+        self.timings = timings or {}  # stage -> seconds spent on the server
+        self.response = response
+
+
+# follows a TracedResponse with the time it took to encode and send it
+class TraceTimings:
+    def __init__(self, trace_id=None, timings=None):
+        self.trace_id = trace_id
+        self.timings = timings or {}
@@ -5,17 +5,31 @@ import threading
 from connection import *
 import json
 from messaging import Codec
+from metrics import Metrics, expose
 from model import *
+from bots import BotEngine
 from ops import *
+from pathfinding import Pathfinder
+from profiling import Profiler
+from timers import TimerWheel
 from protocol import *
-from time import time
+from time import perf_counter, time
 
 
 PLAYER_CHAR_INIT_HP = 10
 PLAYER_CHAR_INIT_DAMAGE = 2
 ARROW_DAMAGE = 2
 ARROW_SPEED = 20
-MAX_JUMP_DISTANCE = 2
+
+
+HANDLERS = {}  # request class -> Server method serving it
+
+
+def handles(request_class):
+    def register(method):
+        HANDLERS[request_class] = method
+        return method
+    return register
 
 
 class Server:
@@ -24,6 +38,16 @@ class Server:
         self._lock = threading.RLock()
         self._connections = {}
         self._next_game_id = 1
+        self._pathfinders = {}  # game_id -> Pathfinder
+        self._move_orders = defaultdict(dict)  # game_id -> {unit_id: (x, y)}
+        self._bots = {}  # game_id -> BotEngine
+        self._timers = {}  # game_id -> TimerWheel of bot cooldowns keyed by (unit_id, action)
+        self.metrics = Metrics()
+        self._handler_metrics = {}  # request class -> (requests, errors, latency)
+        self._acked_seq = {}  # (game_id, player_id) -> seq of the last input served
+        self._tick_seconds = self.metrics.histogram('tick_seconds')
+        self._disconnects = self.metrics.counter('disconnects_total')
+        self.profiler = Profiler()
 
     def connect(self, game_id, player_id): #, auth_token):
         with self._lock:
@@ -33,10 +57,28 @@ class Server:
             conn_key = (game_id, player_id)
             if conn_key in self._connections:
                 logging.warning('Replacing connection %s', conn_key)
-            conn = Connection()
+            conn = Connection(game_id, player_id)
+            conn.last_seen_ts = time()
             self._connections[conn_key] = conn
             return conn
 
+    def disconnect(self, conn):
+        """ Forget the connection and drop its queues. Returns whether the game has
+            any connections left. """
+        with self._lock:
+            conn_key = (conn.game_id, conn.player_id)
+            if self._connections.get(conn_key) is conn:  # not replaced by a reconnect meanwhile
+                del self._connections[conn_key]
+                self._disconnects.inc()
+            conn.incoming.clear()
+            conn.outgoing.clear()
+            return bool(self.get_connections(conn.game_id))
+
+    def silent_connections(self, since):
+        """ Connections nothing was received from since then. """
+        with self._lock:
+            return [conn for conn in self._connections.values() if conn.last_seen_ts < since]
+
     def get_connection(self, game_id, player_id):
         with self._lock:
             conn_key = (game_id, player_id)
@@ -46,126 +88,322 @@ class Server:
         with self._lock:
             return list(conn for conn_key, conn in self._connections.items() if conn_key[0] == game_id)
 
+    def mark_dirty(self, game_id, player_id=None):
+        """ The game has changed, every connection to it has to be updated. Changes made
+            by player_id are urgent for the player and those who can see their unit. """
+        with self._lock:
+            game = self._games[game_id]
+            char = next(iter(game.units_by_player[player_id]), None) if player_id else None
+            for conn in self.get_connections(game_id):
+                conn.dirty = True
+                if player_id and conn.player_id == player_id:
+                    conn.urgent = True
+                elif char and conn.player_id in game.visibility and game.get_visibility(conn.player_id, char.x, char.y) > 0.5:
+                    conn.urgent = True
+
     def get_game(self, game_id):
         with self._lock:
             return self._games[game_id]
 
+    def game_response(self, game_id, player_id):
+        with self._lock:
+            return GetGameResponse(self._games[game_id], self._acked_seq.get((game_id, player_id)), time())
+
+    def _ack(self, request):
+        # acknowledged even if the input gets rejected, the client has to learn that too
+        if request.seq is not None:
+            self._acked_seq[(request.game_id, request.player_id)] = request.seq
+
+    def get_pathfinder(self, game_id):
+        with self._lock:
+            if game_id not in self._pathfinders:
+                self._pathfinders[game_id] = Pathfinder(self._games[game_id].maze)
+            return self._pathfinders[game_id]
+
+    def get_timers(self, game_id):
+        with self._lock:
+            if game_id not in self._timers:
+                self._timers[game_id] = TimerWheel(self._games[game_id].tick)
+            return self._timers[game_id]
+
+    def next_tick(self, game_id):
+        with self._lock:
+            game = self._games[game_id]
+            game.next_tick()
+            MazeOp(game.maze).expire_decals(game.tick)
+            if game_id in self._timers:
+                self._timers[game_id].advance(game.tick)
+
     def process_connections(self):
         with self._lock:
             for conn in self._connections.values():
                 while conn.incoming:
                     request = conn.incoming.pop(0)
+                    self._report_rtt(conn, request)
                     response = self.serve(request)
                     if response:
                         conn.outgoing.append(response)
 
+    def _report_rtt(self, conn, request):
+        """ Pass the round trip a client measured on to its connection, wherever the ping is packed. """
+        if isinstance(request, PingRequest) and request.rtt is not None:
+            conn.report_rtt(request.rtt)
+        elif isinstance(request, BatchRequest):
+            for sub_request in request.requests:
+                self._report_rtt(conn, sub_request)
+        elif isinstance(request, TracedRequest):
+            self._report_rtt(conn, request.request)
+
     def serve(self, request):
         with self._lock:
-            try:
-                if isinstance(request, CreateGameRequest):
-                    game = self._create_game()
-
-                    player = GameOp(game).add_player(request.player_name)
-                    GameOp(game).spawn_unit(char := Unit(hp=PLAYER_CHAR_INIT_HP, damage=PLAYER_CHAR_INIT_DAMAGE, player_id=player.id))
-                    GameOp(game).update_visibility(player.id, char.x, char.y)
-
-                    game_id = self._next_game_id
-                    self._next_game_id += 1
-                    self._games[game_id] = game
-
-                    logging.debug('self._games = %s', self._games)
-
-                    return CreateGameResponse(game_id, player.id)
-
-                elif isinstance(request, GetGameRequest):
-                    return GetGameResponse(self._games[request.game_id])
-
-                elif isinstance(request, JoinGameRequest):
-                    game = self._games[request.game_id]
-                    player = GameOp(game).add_player(request.player_name)
-                    GameOp(game).spawn_unit(char := Unit(hp=PLAYER_CHAR_INIT_HP, damage=PLAYER_CHAR_INIT_DAMAGE, player_id=player.id))
-                    GameOp(game).update_visibility(player.id, char.x, char.y)
-                    return JoinGameResponse(player.id)
-
-                elif isinstance(request, MoveCharRequest):
-                    game = self._games[request.game_id]
-                    char = game.entities[request.unit_id]
-                    assert char.player_id == request.player_id
-                    assert abs(char.x - request.x) <= 1 and abs(char.y - request.y) <= 1
-                    assert (request.x, request.y) in game.maze.free_cells - game.occupied_cells
-                    EntityOp(char).move(request.x, request.y)
-                    GameOp(game).update_visibility(request.player_id, char.x, char.y)
-
-                elif isinstance(request, AttackRequest):
-                    game = self._games[request.game_id]
-                    char = game.entities[request.unit_id]
-                    assert abs(char.x - request.x) <= 1 and abs(char.y - request.y) <= 1
-                    target = next(unit for unit in game.units if (unit.x, unit.y) == (request.x, request.y))
-                    UnitOp(target).take_damage(char.damage, game.tick)
-                    if target.dead:
-                        GameOp(game).add_entity(Grave(x=target.x, y=target.y))
-                        GameOp(game).remove_entity(target)
-
-                elif isinstance(request, OpenRequest):
-                    game = self._games[request.game_id]
-                    char = game.entities[request.unit_id]
-                    assert abs(char.x - request.x) <= 1 and abs(char.y - request.y) <= 1
-                    assert game.maze.get(request.x, request.y) == '+'
-                    MazeOp(game.maze).open_door(request.x, request.y)
-
-                elif isinstance(request, FireRequest):
-                    game = self._games[request.game_id]
-                    char = game.entities[request.unit_id]
-                    assert (char.x, char.y) != (request.x, request.y)
-                    GameOp(game).add_entity(Projectile(damage=ARROW_DAMAGE, speed=ARROW_SPEED, \
-                        start_x=char.x, start_y=char.y, target_x=request.x, target_y=request.y, start_time=time())
-                    )
-
-                elif isinstance(request, PingRequest):
-                    return PingResponse(time())
-
-                elif isinstance(request, JumpRequest):
-                    game = self._games[request.game_id]
-                    char = game.entities[request.unit_id]
-                    assert char.player_id == request.player_id
-                    assert abs(char.x - request.x) <= MAX_JUMP_DISTANCE and abs(char.y - request.y) <= MAX_JUMP_DISTANCE
-                    UnitOp(char).jump(request.x, request.y, game.tick, game.maze.free_cells - game.occupied_cells)
-                    GameOp(game).update_visibility(request.player_id, char.x, char.y)
-
-                elif isinstance(request, TeleportRequest):
-                    game = self._games[request.game_id]
-                    char = game.entities[request.unit_id]
-                    assert char.player_id == request.player_id
-                    assert game.get_visibility(char.player_id, request.x, request.y) >= 0.5  # TODO: move validation inside the *Op
-                    assert (request.x, request.y) in game.maze.free_cells - game.occupied_cells
-                    UnitOp(char).teleport(request.x, request.y, game.tick)
-                    GameOp(game).update_visibility(request.player_id, char.x, char.y)
-
-                else:
-                    raise RuntimeError('Unknown request %s', type(request))
+            request_type = type(request)
+            handler = HANDLERS.get(request_type)
+            if not handler:
+                logging.error('Unknown request %s', request_type)
+                return None
+
+            if request_type not in self._handler_metrics:
+                name = request_type.__name__
+                self._handler_metrics[request_type] = (
+                    self.metrics.counter('requests_total', type=name),
+                    self.metrics.counter('request_errors_total', type=name),
+                    self.metrics.histogram('request_seconds', type=name))
+            requests, errors, latency = self._handler_metrics[request_type]
 
+            requests.inc()
+            start = perf_counter()
+            try:
+                if self.profiler.active:
+                    with self.profiler.capture(getattr(request, 'game_id', None)):
+                        return handler(self, request)
+                return handler(self, request)
             except Exception as e:
+                errors.inc()
                 logging.exception(e)
+            finally:
+                latency.observe(perf_counter() - start)
+
+    @handles(BatchRequest)
+    def _batch_handler(self, request):
+        # the lock is held for the whole batch, so no other request or tick gets in between
+        responses = [response for sub_request in request.requests if (response := self.serve(sub_request))]
+        if responses:
+            return BatchResponse(responses)
+
+    @handles(TracedRequest)
+    def _traced_handler(self, request):
+        start = time()
+        response = self.serve(request.request)
+        served = time()
+        timings = {'queue': start - request.received_at if request.received_at else 0, 'serve': served - start}
+        return TracedResponse(request.trace_id, request.client_time, served, timings, response)
 
-    def _create_game(self):
+    @handles(CreateGameRequest)
+    def _create_game_handler(self, request):
+        game = self._create_game(request.maze_width, request.maze_height)
+
+        player = GameOp(game).add_player(request.player_name)
+        GameOp(game).spawn_unit(char := Unit(hp=PLAYER_CHAR_INIT_HP, damage=PLAYER_CHAR_INIT_DAMAGE, player_id=player.id))
+        GameOp(game).update_visibility(player.id, char.x, char.y)
+
+        game_id = self._next_game_id
+        self._next_game_id += 1
+        self._games[game_id] = game
+
+        logging.debug('self._games = %s', self._games)
+
+        return CreateGameResponse(game_id, player.id)
+
+    @handles(GetGameRequest)
+    def _get_game_handler(self, request):
+        return self.game_response(request.game_id, request.player_id)
+
+    @handles(JoinGameRequest)
+    def _join_game_handler(self, request):
+        game = self._games[request.game_id]
+        player = GameOp(game).add_player(request.player_name)
+        GameOp(game).spawn_unit(char := Unit(hp=PLAYER_CHAR_INIT_HP, damage=PLAYER_CHAR_INIT_DAMAGE, player_id=player.id))
+        GameOp(game).update_visibility(player.id, char.x, char.y)
+        return JoinGameResponse(player.id)
+
+    @handles(MoveCharRequest)
+    def _move_char_handler(self, request):
+        self._ack(request)
+        game = self._games[request.game_id]
+        char = game.entities[request.unit_id]
+        assert char.player_id == request.player_id
+        assert GameOp(game).can_move(char, request.x, request.y, game.tick)
+        self._move_orders[request.game_id].pop(char.id, None)
+        EntityOp(char).move(request.x, request.y)
+        UnitOp(char).act('move', game.tick)
+        GameOp(game).update_visibility(request.player_id, char.x, char.y)
+
+    @handles(AttackRequest)
+    def _attack_handler(self, request):
+        game = self._games[request.game_id]
+        char = game.entities[request.unit_id]
+        assert abs(char.x - request.x) <= 1 and abs(char.y - request.y) <= 1
+        assert UnitOp(char).ready('melee', game.tick)
+        target = next(unit for unit in game.units if (unit.x, unit.y) == (request.x, request.y))
+        GameOp(game).hit(target, char.damage)
+        UnitOp(char).act('melee', game.tick)
+
+    @handles(OpenRequest)
+    def _open_handler(self, request):
+        self._ack(request)
+        game = self._games[request.game_id]
+        char = game.entities[request.unit_id]
+        assert GameOp(game).can_open(char, request.x, request.y)
+        MazeOp(game.maze).open_door(request.x, request.y)
+
+    @handles(FireRequest)
+    def _fire_handler(self, request):
+        game = self._games[request.game_id]
+        char = game.entities[request.unit_id]
+        assert (char.x, char.y) != (request.x, request.y)
+        assert UnitOp(char).ready('fire', game.tick)
+        GameOp(game).add_entity(Projectile(damage=ARROW_DAMAGE, speed=ARROW_SPEED, \
+            start_x=char.x, start_y=char.y, target_x=request.x, target_y=request.y, start_time=time())
+        )
+        UnitOp(char).act('fire', game.tick)
+
+    @handles(PingRequest)
+    def _ping_handler(self, request):
+        return PingResponse(time(), request.client_time)
+
+    @handles(JumpRequest)
+    def _jump_handler(self, request):
+        self._ack(request)
+        game = self._games[request.game_id]
+        char = game.entities[request.unit_id]
+        assert char.player_id == request.player_id
+        assert GameOp(game).can_jump(char, request.x, request.y, game.tick)
+        self._move_orders[request.game_id].pop(char.id, None)
+        UnitOp(char).jump(request.x, request.y, game.tick, GameOp(game).walkable_cells)
+        UnitOp(char).act('jump', game.tick)
+        GameOp(game).update_visibility(request.player_id, char.x, char.y)
+
+    @handles(TeleportRequest)
+    def _teleport_handler(self, request):
+        game = self._games[request.game_id]
+        char = game.entities[request.unit_id]
+        assert char.player_id == request.player_id
+        assert game.get_visibility(char.player_id, request.x, request.y) >= 0.5  # TODO: move validation inside the *Op
+        assert (request.x, request.y) in GameOp(game).walkable_cells
+        assert UnitOp(char).ready('teleport', game.tick)
+        self._move_orders[request.game_id].pop(char.id, None)
+        UnitOp(char).teleport(request.x, request.y, game.tick)
+        UnitOp(char).act('teleport', game.tick)
+        GameOp(game).update_visibility(request.player_id, char.x, char.y)
+
+    @handles(MoveToRequest)
+    def _move_to_handler(self, request):
+        game = self._games[request.game_id]
+        char = game.entities[request.unit_id]
+        assert char.player_id == request.player_id
+        assert (request.x, request.y) in self.get_pathfinder(request.game_id).walkable
+        self._move_orders[request.game_id][char.id] = (request.x, request.y)
+
+    def _create_game(self, width=None, height=None):
         game = Game()
-        GameOp(game).init()
+        GameOp(game).init(width, height)
         MazeOp(game.maze).generate()
         return game
 
     def simulate(self, game_id):
+        with self._lock:
+            if self.profiler.active:
+                with self.profiler.capture(game_id):
+                    return self._simulate(game_id)
+            return self._simulate(game_id)
+
+    def _simulate(self, game_id):
+        start = perf_counter()
+        game = self._games[game_id]
+        game_changed = GameOp(game).simulate(time())
+        game_changed = self._execute_move_orders(game_id) or game_changed
+        if game_id in self._bots:
+            game_changed = self._bots[game_id].tick() or game_changed
+        self._tick_seconds.observe(perf_counter() - start)
+        return game_changed
+
+    def expose_metrics(self):
+        """ Collected metrics plus the gauges computed right now, in Prometheus text format. """
+        with self._lock:
+            gauges = Metrics()
+            gauges.gauge('games').set(len(self._games))
+            gauges.gauge('connections').set(len(self._connections))
+            gauges.gauge('entities').set(sum(len(game.entities) for game in self._games.values()))
+            gauges.gauge('bots').set(sum(len(bots.bot_ids) for bots in self._bots.values()))
+            for (game_id, player_id), conn in self._connections.items():
+                gauges.gauge('connection_incoming_queue', game_id=game_id, player_id=player_id).set(len(conn.incoming))
+                gauges.gauge('connection_outgoing_queue', game_id=game_id, player_id=player_id).set(len(conn.outgoing))
+                gauges.gauge('connection_update_interval_seconds', game_id=game_id, player_id=player_id).set(conn.update_interval)
+            return expose(self.metrics, gauges)
+
+    def add_bots(self, game_id, count):
+        """ Returns the ids of the bots added, fewer than count if the maze gets full. """
+        with self._lock:
+            count = min(count, len(GameOp(self._games[game_id]).walkable_cells))
+            if game_id not in self._bots:
+                self._bots[game_id] = BotEngine(self._games[game_id], self.get_pathfinder(game_id), self.get_timers(game_id))
+            return [self._bots[game_id].add_bot() for _ in range(count)]
+
+    def _execute_move_orders(self, game_id):
+        """ Advance every MoveToRequest of the game by a single step. """
         game = self._games[game_id]
-        return GameOp(game).simulate(time())
+        orders = self._move_orders[game_id]
+        if not orders:
+            return False
+
+        pathfinder = self.get_pathfinder(game_id)
+        occupied = game.occupied_cells
+        game_changed = False
+        for unit_id, target in list(orders.items()):
+            unit = game.entities.get(unit_id)
+            if not unit or unit.pos == target:
+                del orders[unit_id]
+                continue
+            if not UnitOp(unit).ready('move', game.tick):
+                continue
+            step = pathfinder.next_step(unit.pos, target, blocked=occupied)
+            if not step:
+                if target in occupied:  # taken by another unit, this is as close as it gets
+                    del orders[unit_id]
+                continue  # blocked by other units, try again next tick
+            occupied.discard(unit.pos)
+            EntityOp(unit).move(*step)
+            occupied.add(step)
+            UnitOp(unit).act('move', game.tick)
+            if unit.player_id:
+                GameOp(game).update_visibility(unit.player_id, unit.x, unit.y)
+            game_changed = True
+        return game_changed
 
     def save(self, fout):
+        start = perf_counter()
         data = {'games': self._games, 'next_id': self._next_game_id}
         codec = Codec(auto_register=True, globals=globals())
         fout.write(codec.encode(data))
+        self.metrics.histogram('checkpoint_seconds', op='save').observe(perf_counter() - start)
 
     def load(self, fin):
+        start = perf_counter()
         codec = Codec(auto_register=True, globals=globals())
         data = codec.decode(fin.read())
+        self.metrics.histogram('checkpoint_seconds', op='load').observe(perf_counter() - start)
         self._games = data['games']
+        for game in self._games.values():
+            GameOp(game).retire_spent()
         self._next_game_id = data['next_id']
         self._lock = threading.RLock()
         self._connections.clear()
+        self._pathfinders.clear()
+        self._move_orders.clear()
+        self._acked_seq.clear()
+        self._bots.clear()
+        self._timers.clear()
+        for game_id, game in self._games.items():
+            if bot_ids := {unit.id for unit in game.units if not unit.player_id}:  # the units no player owns are bots
+                self._bots[game_id] = BotEngine(game, self.get_pathfinder(game_id), self.get_timers(game_id))
+                self._bots[game_id].bot_ids.update(bot_ids)
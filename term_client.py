@@ -1,22 +1,292 @@
 #! /usr/bin/python3
 
+import argparse
 import asyncio
 import aiohttp
-import copy
+import curses
 import logging
-#import requests
-#import websockets
+import sys
+import time
 
+import autotile
 from client import Client
 from connection import Connection
 from messaging import Codec
 import model
-import protocol
-from threading import Thread, Lock
-import time
+from protocol import *
+
+
+PING_INTERVAL = 5
+PING_TIMEOUT = 10
+MIN_REDRAW_INTERVAL = 0.05 # changes coming faster are drawn together
+CAMERA_MARGIN = 4 # cells between the char and the edge of the view before it scrolls
+STATUS_HEIGHT = 1
+KEY_DELTAS = {
+    curses.KEY_LEFT: (-1, 0), ord('a'): (-1, 0), ord('h'): (-1, 0),
+    curses.KEY_RIGHT: (1, 0), ord('d'): (1, 0), ord('l'): (1, 0),
+    curses.KEY_UP: (0, -1), ord('w'): (0, -1), ord('k'): (0, -1),
+    curses.KEY_DOWN: (0, 1), ord('s'): (0, 1), ord('j'): (0, 1),
+}
+DIRECTION_DELTAS = {model.LEFT: (-1, 0), model.RIGHT: (1, 0), model.UP: (0, -1), model.DOWN: (0, 1)}
+
+
+def wall_glyphs():
+    """ Line drawing characters by wall tile code; only known once curses is initialized. """
+    UP, DOWN, LEFT, RIGHT = autotile.UP, autotile.DOWN, autotile.LEFT, autotile.RIGHT # not the model directions
+    lines = {
+        0: ord('#'),
+        UP: curses.ACS_VLINE, DOWN: curses.ACS_VLINE, UP | DOWN: curses.ACS_VLINE,
+        LEFT: curses.ACS_HLINE, RIGHT: curses.ACS_HLINE, LEFT | RIGHT: curses.ACS_HLINE,
+        DOWN | RIGHT: curses.ACS_ULCORNER, DOWN | LEFT: curses.ACS_URCORNER,
+        UP | RIGHT: curses.ACS_LLCORNER, UP | LEFT: curses.ACS_LRCORNER,
+        UP | DOWN | RIGHT: curses.ACS_LTEE, UP | DOWN | LEFT: curses.ACS_RTEE,
+        DOWN | LEFT | RIGHT: curses.ACS_TTEE, UP | LEFT | RIGHT: curses.ACS_BTEE,
+        UP | DOWN | LEFT | RIGHT: curses.ACS_PLUS,
+    }
+    return {autotile.WALL + mask: glyph for mask, glyph in lines.items()}
+
+
+def tile_glyphs():
+    """ Glyph by autotile code, plain ASCII walls. """
+    return {code: ord({None: ' ', 'floor': '.', 'door-closed': '+'}.get(tile, '#')) for code, tile in enumerate(autotile.TILES)}
+
+
+def entity_glyph(entity, player_id):
+    if isinstance(entity, model.Unit):
+        if entity.player_id == player_id:
+            return ord('@'), curses.A_BOLD
+        return ord('@' if entity.player_id else '&'), 0
+    if isinstance(entity, model.Projectile):
+        return ord('-' if entity.direction in (model.LEFT, model.RIGHT) else '|'), curses.A_BOLD
+    if isinstance(entity, model.Grave):
+        return ord('%'), 0
+    return ord('?'), 0
+
+
+def follow(camera, target, view_size, maze_size, margin=CAMERA_MARGIN):
+    """ Camera scrolled just enough to keep the target margin cells away from the edges of the view. """
+    (cx, cy), (width, height), (maze_width, maze_height) = camera, view_size, maze_size
+    if target:
+        margin_x, margin_y = min(margin, (width - 1) // 2), min(margin, (height - 1) // 2)
+        cx = min(max(cx, target[0] + margin_x + 1 - width), target[0] - margin_x)
+        cy = min(max(cy, target[1] + margin_y + 1 - height), target[1] - margin_y)
+    return min(max(cx, 0), max(maze_width - width, 0)), min(max(cy, 0), max(maze_height - height, 0))
+
+
+def compose(game, player_id, autotile, glyphs, camera, view_size, spectate=False):
+    """ Rows of (glyph, attr) cells of the view. Players see what they have never seen as blank
+        and what they don't see right now dimmed, without the units there; spectators see everything. """
+    (cx, cy), (width, height) = camera, view_size
+    maze = game.maze
+    width, height = min(width, maze.width - cx), min(height, maze.height - cy)
+    visibility = None if spectate else game.visibility[player_id]
+    frame = []
+    for y in range(cy, cy + height):
+        codes = autotile.rows[y]
+        if visibility is None:
+            row = [(glyphs[codes[x]], 0) for x in range(cx, cx + width)]
+        else:
+            seen = visibility[y]
+            row = [(glyphs[codes[x]], 0 if seen[x] > 0.5 else curses.A_DIM) if seen[x] else (ord(' '), 0) for x in range(cx, cx + width)]
+        frame.append(row)
+    for entity in game.entities.values():
+        x, y = entity.x - cx, entity.y - cy
+        if 0 <= x < width and 0 <= y < height and (visibility is None or visibility[entity.y][entity.x] > 0.5):
+            glyph, attr = entity_glyph(entity, player_id)
+            frame[y][x] = (glyph, attr)
+    return frame
+
+
+def changed_cells(old, new):
+    """ (x, y, glyph, attr) of the cells that differ; all of the new frame if the old one is missing. """
+    changed = []
+    for y, row in enumerate(new):
+        old_row = old[y] if old and y < len(old) else None
+        if row == old_row:
+            continue
+        for x, cell in enumerate(row):
+            if old_row is None or x >= len(old_row) or old_row[x] != cell:
+                changed.append((x, y, *cell))
+    return changed
+
+
+class TerminalRenderer:
+    """ Draws the game with curses, writing only the cells changed since the last frame,
+        so a redraw costs next to nothing over a slow link. """
+
+    def __init__(self, screen, spectate=False):
+        self.screen = screen
+        self.spectate = spectate
+        self.autotile = autotile.AutotileIndex()
+        self.glyphs = {**tile_glyphs(), **wall_glyphs()}
+        self.camera = None # maze cell at the top left corner of the screen
+        self.scroll = (0, 0) # spectator's camera moves, applied on the next frame
+        self.prev_frame = None
+        self.prev_status = None
+
+    def resize(self):
+        self.screen.clear()
+        self.prev_frame = self.prev_status = None
+
+    def view_size(self):
+        rows, cols = self.screen.getmaxyx()
+        return cols, max(rows - STATUS_HEIGHT, 1)
+
+    def render(self, client):
+        if not client.game:
+            return
+        game = client.game
+        self.autotile.update(game.maze)
+        view_size = self.view_size()
+        maze_size = (game.maze.width, game.maze.height)
+        char = client.char
+        if self.camera is None:
+            self.camera = (char.x - view_size[0] // 2, char.y - view_size[1] // 2) if char else (0, 0)
+        if self.spectate:
+            self.camera = follow((self.camera[0] + self.scroll[0], self.camera[1] + self.scroll[1]), None, view_size, maze_size)
+            self.scroll = (0, 0)
+        else:
+            self.camera = follow(self.camera, char.pos if char else None, view_size, maze_size)
+
+        frame = compose(game, client.player_id, self.autotile, self.glyphs, self.camera, view_size, self.spectate)
+        if self.prev_frame and frame and (len(frame) != len(self.prev_frame) or len(frame[0]) != len(self.prev_frame[0])):
+            self.screen.erase() # cells the frame no longer covers
+            self.prev_frame = self.prev_status = None
+        for x, y, glyph, attr in changed_cells(self.prev_frame, frame):
+            self.put(y, x, glyph, attr)
+        self.prev_frame = frame
+
+        status = f' game {client.game_id} player {client.player_id}'
+        if self.spectate:
+            status += '  spectating, arrows scroll'
+        elif char:
+            status += f'  hp {char.hp}  at {char.x},{char.y}'
+        else:
+            status += '  dead'
+        status = status.ljust(view_size[0])[:view_size[0]]
+        if status != self.prev_status:
+            for x, c in enumerate(status):
+                self.put(view_size[1], x, ord(c), curses.A_REVERSE)
+            self.prev_status = status
 
+        self.screen.noutrefresh()
+        curses.doupdate()
 
-async def async_main():
+    def put(self, y, x, glyph, attr):
+        try:
+            self.screen.addch(y, x, glyph, attr)
+        except curses.error:
+            pass # the bottom right cell can be written but not moved past
+
+
+def handle_key(key, client, renderer):
+    """ Returns False to quit. """
+    if key == ord('q'):
+        return False
+    if key == curses.KEY_RESIZE:
+        renderer.resize()
+    elif key in KEY_DELTAS:
+        dx, dy = KEY_DELTAS[key]
+        if renderer.spectate:
+            renderer.scroll = (renderer.scroll[0] + dx, renderer.scroll[1] + dy)
+        elif client.game and (char := client.char):
+            x, y = char.x + dx, char.y + dy
+            if any(unit.pos == (x, y) for unit in client.game.units):
+                client.attack(char.id, x, y)
+            elif client.game.maze.get(x, y) == '+':
+                client.open_door(char.id, x, y)
+            else:
+                client.move_char(char.id, x, y)
+    elif key == ord(' ') and not renderer.spectate and client.game and (char := client.char):
+        dx, dy = DIRECTION_DELTAS[char.direction]
+        client.fire(char.id, char.x + dx, char.y + dy)
+    return True
+
+
+async def write_socket(ws, codec, client, queued):
+    """ The only sender, so messages go out in the order queued; waits to be told of new ones. """
+    connection = client.connection
+    while True:
+        await queued.wait()
+        queued.clear()
+        client.batch_outgoing()
+        messages, connection.outgoing[:] = connection.outgoing[:], []
+        for message in messages:
+            await ws.send_str(codec.encode(message))
+
+
+async def read_socket(ws, codec, client, changed, queued):
+    async for msg in ws:
+        if msg.type == aiohttp.WSMsgType.TEXT:
+            client.connection.incoming.append(codec.decode(msg.data))
+            client.process_connection()
+            changed.set()
+            queued.set()
+        elif msg.type in (aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.ERROR):
+            logging.debug('Websocket closed: %s', msg.type)
+            break
+
+
+async def keep_alive(ws, client, queued):
+    while not ws.closed:
+        if client.last_ping_ts and time.time() - client.last_ping_ts > PING_TIMEOUT:
+            logging.debug('Connection lost')
+            await ws.close()
+            break
+        if not client.last_ping_ts:
+            client.ping()
+            queued.set()
+        await asyncio.sleep(PING_INTERVAL)
+
+
+async def draw(client, renderer, changed):
+    """ Redraw on every change, waiting for one rather than polling. """
+    while True:
+        await changed.wait()
+        changed.clear()
+        renderer.render(client)
+        await asyncio.sleep(MIN_REDRAW_INTERVAL)
+
+
+async def play(screen, session, client, spectate):
+    codec = Codec(auto_register=True, globals=globals())
+    curses.curs_set(0)
+    screen.nodelay(True)
+    screen.keypad(True)
+    renderer = TerminalRenderer(screen, spectate)
+    changed = asyncio.Event()
+    queued = asyncio.Event()  # the client has messages to send
+    stop = asyncio.Event()
+
+    async with session.ws_connect(f'http://localhost:8080/connect?game_id={client.game_id}&player_id={client.player_id}') as ws:
+        logging.debug('Connected')
+        client.on_connected()
+        queued.set()
+
+        def on_keys():
+            sent = False
+            while (key := screen.getch()) != -1:
+                if not handle_key(key, client, renderer):
+                    stop.set()
+                    return
+                sent = True
+            if sent:
+                changed.set()
+                queued.set()
+
+        loop = asyncio.get_running_loop()
+        loop.add_reader(sys.stdin.fileno(), on_keys)
+        tasks = [asyncio.create_task(coro) for coro in (read_socket(ws, codec, client, changed, queued), write_socket(ws, codec, client, queued),
+                                                        keep_alive(ws, client, queued), draw(client, renderer, changed), stop.wait())]
+        try:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            loop.remove_reader(sys.stdin.fileno())
+            for task in tasks:
+                task.cancel()
+
+
+async def async_main(args):
     s = ''
     while s not in ('C', 'J', 'O'):
         print('(C)reate, (J)oin, c(O)nnect? ', end='')
@@ -31,7 +301,7 @@ async def async_main():
         elif s == 'J':
             print('Enter game_id: ', end='')
             game_id = int(input())
-            async with session.get('http://localhost:8080/join', params={'name': 'player2'}) as response:
+            async with session.get('http://localhost:8080/join', params={'name': 'player2', 'game_id': game_id}) as response:
                 j = await response.json()
                 player_id = j['player_id']
         elif s == 'O':
@@ -40,81 +310,27 @@ async def async_main():
             print('Enter player_id: ', end='')
             player_id = int(input())
 
-        # create client
-        connection = Connection()
-        client = Client(game_id, player_id, connection)
-        client_lock = Lock()
-
-        render_thread = Thread(target=render, args=(client, client_lock))
-        render_thread.start()
-
-        # connect
-        codec = Codec()
-        for obj in (protocol.GetGameRequest, protocol.GetGameResponse, protocol.MoveCharRequest, model.Game, model.Player, model.Maze, model.Unit):
-            codec.register(obj)
-
-        logging.debug('Connecting...')
-        async with session.ws_connect(f'http://localhost:8080/connect?game_id={game_id}&player_id={player_id}') as ws:
-            logging.debug('Connected')
-            logging.debug('DIR = %s', dir(ws))
-
-            client.fetch_game()
-            while connection.outgoing:
-                message = connection.outgoing.pop(0)
-                await ws.send_str(codec.encode(message))
-
-            async for msg in ws:
-                if msg.type == aiohttp.WSMsgType.TEXT:
-                    message = codec.decode(msg.data)
-                    connection.incoming.append(message)
-                    with client_lock:
-                        client.process_connection()
-                    while connection.outgoing:
-                        message = connection.outgoing.pop(0)
-                        await ws.send_str(codec.encode(message))
-                elif msg.type == aiohttp.WSMsgType.CLOSED:
-                    logging.debug('Websocket closed')
-                    break
-                elif msg.type == aiohttp.WSMsgType.ERROR:
-                    logging.debug('Websocket error')
-                    break
-
-        # render_thread.join()
-
-
-def render(client, lock):
-    fetch_count = -1
-    while True:
-        with lock:
-            if not client.game or client.fetch_count == fetch_count:
-                continue
-
-            fetch_count = client.fetch_count
-
-            render_map = copy.deepcopy(client.game.maze.map)
-            for ent in client.game.entities.values():
-                render_map[ent.y][ent.x] = '@'
-            print('-' * 80)
-            print('\n'.join(''.join(row) for row in render_map))
-            # time.sleep(1)
-
-            print('AWSD? ', end='')
-            command = ''
-            while not command or command not in 'AWSD':
-                command = input().upper()
-
-            delta = {
-                'A': (-1, 0),
-                'W': (0, -1),
-                'S': (0, 1),
-                'D': (1, 0)
-            }[command]
-            client.move_char(client.char.id, client.char.x + delta[0], client.char.y + delta[1])
+        client = Client(game_id, player_id, Connection())
+        screen = curses.initscr()
+        curses.noecho()
+        curses.cbreak()
+        try:
+            await play(screen, session, client, args.spectate)
+        finally:
+            curses.nocbreak()
+            screen.keypad(False)
+            curses.echo()
+            curses.endwin()
 
 
 def main():
-    logging.basicConfig(level=logging.DEBUG)
-    asyncio.get_event_loop().run_until_complete(async_main())
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('--spectate', default=False, action='store_true',
+                           help='watch the whole maze with a free camera, sending no moves')
+    argparser.add_argument('--log', default='term_client.log', help='the terminal is taken by the game')
+    args = argparser.parse_args()
+    logging.basicConfig(level=logging.DEBUG, filename=args.log)
+    asyncio.run(async_main(args))
 
 
 if __name__ == '__main__':
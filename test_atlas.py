@@ -0,0 +1,36 @@
+import pygame
+
+import atlas
+
+
+def make_art(art_dir, name, color):
+    img = pygame.Surface((8, 8), pygame.SRCALPHA)
+    img.fill(color)
+    pygame.image.save(img, str(art_dir / name))
+
+
+def test_atlas_is_cached_until_art_changes(tmp_path, monkeypatch):
+    # arrange
+    art_dir, cache_dir = tmp_path / 'art', tmp_path / 'cache'
+    art_dir.mkdir()
+    make_art(art_dir, 'arrow.png', (255, 0, 0, 255))
+    make_art(art_dir, 'floor-1.png', (0, 255, 0, 255))
+    make_art(art_dir, 'floor-2.png', (0, 0, 255, 128))
+    builds = []
+    build = atlas.build
+    monkeypatch.setattr(atlas, 'build', lambda art_dir: builds.append(art_dir) or build(art_dir))
+
+    # act
+    image, index = atlas.load(art_dir, cache_dir)
+    atlas.load(art_dir, cache_dir)
+    make_art(art_dir, 'floor-2.png', (0, 0, 255, 255))
+    atlas.load(art_dir, cache_dir)
+
+    # assert
+    assert len(builds) == 2
+    assert len(list(cache_dir.iterdir())) == 2  # the stale atlas got removed
+    assert len(index['arrow']) == 1 and len(index['arrow'][0]) == 8
+    assert len(index['floor']) == 2
+    sprites = atlas.sprites(image, index)
+    assert sprites['floor'][1][0].get_at((0, 0)) == (0, 0, 255, 128)
+    assert sprites['arrow'][0][4].get_at((0, 0)).a == atlas.PROJECTILE_TRAIL_TRANSPARENCY
@@ -0,0 +1,67 @@
+from autotile import *
+from model import Maze
+from ops import MazeOp
+
+
+def make_maze(*rows):
+    return Maze(map=[list(row) for row in rows])
+
+
+def test_walls_take_shape_from_neighbours():
+    # arrange
+    maze = make_maze('---', '|.+', '|--')
+    index = AutotileIndex()
+
+    # act
+    index.update(maze)
+
+    # assert
+    assert index.tile(0, 0) == 'wall-ul'
+    assert index.tile(1, 0) == 'wall-h'
+    assert index.tile(0, 1) == 'wall-v'
+    assert index.tile(0, 2) == 'wall-dl'
+    assert index.tile(1, 1) == 'floor'
+    assert index.tile(2, 1) == 'door-closed'
+
+
+def test_only_cells_around_changes_are_recomputed():
+    # arrange
+    maze = make_maze('-----', '|...|', '|-+-|', '|...|', '-----')
+    index = AutotileIndex()
+    index.update(maze)
+
+    # act
+    unchanged = index.update(maze)
+    MazeOp(maze).open_door(2, 2)
+    opened = index.update(maze)
+    maze.set(1, 2, '.')
+    maze.revision += 1
+    dug = index.update(maze)
+
+    # assert
+    assert unchanged == []
+    assert opened == [(2, 2)]
+    assert sorted(dug) == [(0, 2), (1, 2)]
+    assert index.tile(0, 2) == 'wall-v'
+    assert index.tile(2, 2) == 'floor'
+
+
+def test_predicted_changes_are_found():
+    # arrange
+    maze = make_maze('-----', '|.+.|', '-----')
+    index = AutotileIndex()
+    index.update(maze)
+
+    # act
+    maze.set(2, 1, '.')
+    unnoticed = index.update(maze)  # neither the revision nor a local change tells of it
+    maze.local_changes.append((2, 1))  # as the client predicts an opened door
+    opened = index.update(maze)
+    maze.map, maze.local_changes = [list('-----'), list('|.+.|'), list('-----')], []  # the server's map, same revision
+    closed = index.update(maze)
+
+    # assert
+    assert unnoticed == []
+    assert opened == [(2, 1)]
+    assert closed == [(2, 1)]
+    assert index.tile(2, 1) == 'door-closed'
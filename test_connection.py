@@ -0,0 +1,43 @@
+import pytest
+
+from connection import *
+
+
+def test_update_interval_follows_the_link():
+    # arrange
+    fast, slow, buffered = Connection(), Connection(), Connection()
+
+    # act
+    for i in range(20):
+        fast.report_rtt(0.02)
+        fast.report_send(10000, 0, update=True)
+        slow.report_rtt(0.6)
+        slow.report_send(10000, 0.1, update=True)  # 100 kB/s
+        buffered.report_send(10000, 0.1 if i % 5 == 0 else 0, update=True)  # 100 kB/s, most sends only fill the buffer
+
+    # assert
+    assert fast.drain_rate is None
+    assert fast.update_interval == MIN_UPDATE_INTERVAL
+    assert slow.update_interval == pytest.approx(0.3, rel=0.01)
+    assert buffered.drain_rate == pytest.approx(100000)
+    assert buffered.update_interval == pytest.approx(0.2, rel=0.01)
+
+
+def test_changes_are_coalesced_unless_urgent():
+    # arrange
+    conn = Connection()
+    conn.update_interval = 0.5
+    conn.dirty = True
+    conn.updated(100.0)
+
+    # act
+    clean = conn.update_due(101.0)
+    conn.dirty = True
+    coalesced = conn.update_due(100.1)
+    conn.urgent = True
+    urgent = conn.update_due(100.1)
+
+    # assert
+    assert not clean
+    assert not coalesced
+    assert urgent
@@ -62,3 +62,19 @@ def test_auto_register():
     decoded = codec2.decode(code)
     assert isinstance(decoded, UserVal)
     assert decoded.data == 42
+
+
+def test_slotted_entities():
+    # arrange
+    import model
+    codec = Codec(auto_register=True, globals=vars(model))
+    unit = model.Unit(id=3, x=1, y=2, hp=10, damage=2, player_id=1)
+    unit.effects.hit_tick = 5
+
+    # act
+    decoded = codec.decode(codec.encode(unit))
+
+    # assert
+    assert isinstance(decoded, model.Unit)
+    assert (decoded.id, decoded.pos, decoded.hp, decoded.player_id) == (3, (1, 2), 10, 1)
+    assert decoded.effects.hit_tick == 5
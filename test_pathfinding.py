@@ -0,0 +1,75 @@
+from model import *
+from ops import *
+from pathfinding import *
+
+
+def make_maze(rows):
+    return Maze(map=[list(row) for row in rows])
+
+
+def test_find_path_goes_around_walls():
+    # arrange
+    maze = make_maze([
+        '-------',
+        '|..|..|',
+        '|..|..|',
+        '|.....|',
+        '-------',
+    ])
+
+    # act
+    path = Pathfinder(maze).find_path((1, 1), (5, 1))
+
+    # assert
+    assert path[-1] == (5, 1)
+    assert len(path) == 4
+    assert all(cell in maze.free_cells for cell in path)
+
+
+def test_find_path_unreachable():
+    # arrange
+    maze = make_maze([
+        '-----',
+        '|.|.|',
+        '-----',
+    ])
+
+    # act
+    path = Pathfinder(maze).find_path((1, 1), (3, 1))
+
+    # assert
+    assert path is None
+
+
+def test_distance_field_invalidated_by_open_door():
+    # arrange
+    maze = make_maze([
+        '-----',
+        '|.+.|',
+        '-----',
+    ])
+    pathfinder = Pathfinder(maze)
+    assert pathfinder.distance((1, 1), (3, 1)) == UNREACHABLE
+
+    # act
+    MazeOp(maze).open_door(2, 1)
+
+    # assert
+    assert pathfinder.distance((1, 1), (3, 1)) == 2
+    assert pathfinder.next_step((1, 1), (3, 1)) == (2, 1)
+
+
+def test_next_step_avoids_blocked_cells():
+    # arrange
+    maze = make_maze([
+        '-----',
+        '|...|',
+        '|...|',
+        '-----',
+    ])
+
+    # act
+    step = Pathfinder(maze).next_step((1, 1), (3, 1), blocked={(2, 1)})
+
+    # assert
+    assert step == (2, 2)
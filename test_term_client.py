@@ -0,0 +1,45 @@
+from autotile import AutotileIndex
+from model import Game, Maze, Unit
+from ops import EntityOp, GameOp
+from term_client import *
+
+
+def test_only_changed_cells_are_written():
+    # arrange
+    game = Game(maze=Maze(map=[list('-----'), list('|...|'), list('-----')]))
+    player = GameOp(game).add_player('player')
+    GameOp(game).add_entity(char := Unit(x=1, y=1, player_id=player.id))
+    GameOp(game).update_visibility(player.id, char.x, char.y)
+    index = AutotileIndex()
+    index.update(game.maze)
+    glyphs = tile_glyphs()
+    before = compose(game, player.id, index, glyphs, (0, 0), (5, 3))
+
+    # act
+    EntityOp(char).move(2, 1)
+    after = compose(game, player.id, index, glyphs, (0, 0), (5, 3))
+    changed = changed_cells(before, after)
+
+    # assert
+    assert ''.join(chr(glyph) for glyph, attr in after[1]) == '#.@.#'
+    assert changed == [(1, 1, ord('.'), 0), (2, 1, ord('@'), curses.A_BOLD)]
+    assert len(changed_cells(None, after)) == 15
+
+
+def test_units_out_of_sight_are_not_shown():
+    # arrange
+    game = Game(maze=Maze(map=[list('-' * 24), list('|' + '.' * 22 + '|'), list('-' * 24)]))
+    player = GameOp(game).add_player('player')
+    GameOp(game).add_entity(char := Unit(x=1, y=1, player_id=player.id))
+    GameOp(game).add_entity(Unit(x=20, y=1))
+    GameOp(game).update_visibility(player.id, 20, 1)
+    GameOp(game).update_visibility(player.id, char.x, char.y)  # the bot's cell stays seen, but dimmed
+    index = AutotileIndex()
+    index.update(game.maze)
+
+    # act
+    frame = compose(game, player.id, index, tile_glyphs(), (0, 0), (24, 3))
+
+    # assert
+    assert frame[1][20] == (ord('.'), curses.A_DIM)
+    assert frame[1][1] == (ord('@'), curses.A_BOLD)
@@ -0,0 +1,49 @@
+from timers import *
+
+
+def test_timer_expires_after_delay():
+    # arrange
+    wheel = TimerWheel()
+    wheel.schedule('cooldown', 3)
+
+    # act
+    expired_early = wheel.advance(2)
+    active_early = wheel.active('cooldown')
+    expired = wheel.advance(3)
+
+    # assert
+    assert not expired_early
+    assert active_early
+    assert expired == ['cooldown']
+    assert not wheel.active('cooldown')
+
+
+def test_long_timers_cascade():
+    # arrange
+    wheel = TimerWheel(tick=10)
+    fired = []
+    for delay in (1, WHEEL_SLOTS, WHEEL_SLOTS + 1, WHEEL_SLOTS ** 2 + 5):
+        wheel.schedule(delay, delay, callback=lambda key: fired.append((key, wheel.tick)))
+
+    # act
+    wheel.advance(10 + WHEEL_SLOTS ** 2 + 10)
+
+    # assert
+    assert fired == [(1, 11), (WHEEL_SLOTS, 10 + WHEEL_SLOTS), (WHEEL_SLOTS + 1, 11 + WHEEL_SLOTS), (WHEEL_SLOTS ** 2 + 5, 15 + WHEEL_SLOTS ** 2)]
+    assert not len(wheel)
+
+
+def test_reschedule_and_cancel():
+    # arrange
+    wheel = TimerWheel()
+    wheel.schedule('a', 2)
+    wheel.schedule('b', 2)
+
+    # act
+    wheel.schedule('a', 5)
+    wheel.cancel('b')
+
+    # assert
+    assert wheel.advance(2) == []
+    assert wheel.remaining('a') == 3
+    assert wheel.advance(5) == ['a']
@@ -17,3 +17,40 @@ def test_object_update_from():
     object_update_from(dest, {'val': 43})
     assert dest.val == 43
     assert id(dest) == dest_id
+
+
+def test_object_update_from_slots():
+    class MySlots:
+        __slots__ = ('val', )
+
+        def __init__(self, val):
+            self.val = val
+
+    class MyChildSlots(MySlots):
+        __slots__ = ('other', )
+
+        def __init__(self, val, other):
+            super().__init__(val)
+            self.other = other
+
+    source = MyChildSlots(13, 'a')
+    dest = MyChildSlots(42, 'b')
+
+    object_update_from(dest, source)
+    assert (dest.val, dest.other) == (13, 'a')
+    assert object_state(dest) == {'val': 13, 'other': 'a'}
+
+
+def test_changed_spans():
+    # arrange
+    old = [list('-----'), list('|...|'), list('|.+.|')]
+    new = [list('-----'), list('|...|'), list('|...|')]
+    new[1][1] = '@'
+
+    # act
+    spans = changed_spans(old, new)
+    resized = changed_spans(old, new[:2])
+
+    # assert
+    assert spans == [(1, 1, 1), (2, 2, 2)]
+    assert resized == [(0, 0, 4), (1, 0, 4)]
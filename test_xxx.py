@@ -1,3 +1,4 @@
+import io
 import pytest
 
 from connection import *
@@ -12,14 +13,19 @@ class FakeTransport:
         self.server = server
         self.server_connection = server_connection
         self.client_connection = client_connection
+        self.codec = Codec(auto_register=True, globals=globals())
+
+    def transfer(self, messages):
+        # through the codec, like the real transport, so client and server never share objects
+        return [self.codec.decode(self.codec.encode(message)) for message in messages]
 
     def sync(self):
-        self.server_connection.incoming += self.client_connection.outgoing
+        self.server_connection.incoming += self.transfer(self.client_connection.outgoing)
         self.client_connection.outgoing.clear()
 
         self.server.process_connections()
 
-        self.client_connection.incoming += self.server_connection.outgoing
+        self.client_connection.incoming += self.transfer(self.server_connection.outgoing)
         self.server_connection.outgoing.clear()
 
         self.client.process_connection()
@@ -77,3 +83,459 @@ def test_move_char(client, server, transport):
 
     # assert
     assert char.x == new_x
+
+
+def test_move_to(client, server, transport):
+    # arrange
+    client.fetch_game()
+    transport.sync()
+
+    char = client.game.units_by_player[client.player_id][0]
+    pathfinder = server.get_pathfinder(client.game_id)
+    target = max(pathfinder.walkable, key=lambda cell: pathfinder.distance(cell, char.pos))
+
+    # act
+    client.move_to(char.id, *target)
+    transport.sync()
+    while server.simulate(client.game_id):
+        server.next_tick(client.game_id)
+    client.fetch_game()
+    transport.sync()
+
+    # assert
+    assert char.pos == target
+
+
+def test_move_to_occupied_cell_stops_next_to_it(client, server):
+    # arrange
+    game = server.get_game(client.game_id)
+    game.maze = Maze(map=[list('-' * 8)] + [list('|......|')] + [list('-' * 8)])
+    char = game.units_by_player[client.player_id][0]
+    EntityOp(char).move(1, 1)
+    GameOp(game).add_entity(Unit(x=5, y=1, hp=1))
+    server.serve(MoveToRequest(client.game_id, client.player_id, char.id, 5, 1))
+
+    # act
+    for _ in range(10):
+        server.simulate(client.game_id)
+        server.next_tick(client.game_id)
+
+    # assert
+    assert char.pos == (4, 1)
+    assert not server._move_orders[client.game_id]
+
+
+def test_bots_chase_player(client, server):
+    # arrange
+    game = server.get_game(client.game_id)
+    game.maze = Maze(map=[list('-' * 8)] + [list('|......|') for _ in range(6)] + [list('-' * 8)])
+    char = game.units_by_player[client.player_id][0]
+    EntityOp(char).move(1, 1)
+    GameOp(game).update_visibility(client.player_id, char.x, char.y)
+    server.add_bots(client.game_id, 3)
+
+    # act
+    for _ in range(10):
+        server.simulate(client.game_id)
+        server.next_tick(client.game_id)
+
+    # assert
+    assert char.hp < PLAYER_CHAR_INIT_HP
+
+
+def test_bots_fill_the_maze_at_most(client, server):
+    # arrange
+    free = len(GameOp(server.get_game(client.game_id)).walkable_cells)
+
+    # act
+    bot_ids = server.add_bots(client.game_id, free + 10)
+
+    # assert
+    assert len(bot_ids) == free
+    assert not GameOp(server.get_game(client.game_id)).walkable_cells
+
+
+def test_bots_act_after_load(client, server):
+    # arrange
+    game = server.get_game(client.game_id)
+    game.maze = Maze(map=[list('-' * 10)] + [list('|........|') for _ in range(4)] + [list('-' * 10)])
+    game.visibility[client.player_id] = [[0] * 10 for _ in range(6)]  # the bots see no one to chase, so they wander
+    EntityOp(game.units_by_player[client.player_id][0]).move(1, 1)
+    bot_ids = server.add_bots(client.game_id, 2)
+    saved = io.StringIO()
+    server.save(saved)
+    saved.seek(0)
+    loaded = Server()
+
+    # act
+    loaded.load(saved)
+    positions = {bot_id: loaded.get_game(client.game_id).entities[bot_id].pos for bot_id in bot_ids}
+    for _ in range(5):
+        loaded.simulate(client.game_id)
+        loaded.next_tick(client.game_id)
+
+    # assert
+    game = loaded.get_game(client.game_id)
+    assert loaded._bots[client.game_id].bot_ids == set(bot_ids)
+    assert any(game.entities[bot_id].pos != pos for bot_id, pos in positions.items())
+
+
+def test_spent_arrow_becomes_decal(client, server):
+    # arrange
+    game = server.get_game(client.game_id)
+    char = game.units_by_player[client.player_id][0]
+    server.serve(FireRequest(client.game_id, client.player_id, char.id, char.x + 1, char.y))
+    arrow = next(entity for entity in game.entities.values() if isinstance(entity, Projectile))
+    arrow.start_time -= 10  # long enough to hit a wall
+
+    # act
+    server.simulate(client.game_id)
+
+    # assert
+    assert arrow.id not in game.entities
+    assert list(game.maze.decals.values()) == [[ARROW_DECAL, RIGHT, game.tick]]
+
+
+def test_arrow_kill_leaves_a_grave():
+    # arrange
+    game = Game(maze=Maze(map=[list('-' * 8)] + [list('|......|')] + [list('-' * 8)]))
+    GameOp(game).add_entity(victim := Unit(x=3, y=1, hp=1))
+    GameOp(game).add_entity(Projectile(damage=ARROW_DAMAGE, speed=ARROW_SPEED, start_x=1, start_y=1, target_x=2, target_y=1, start_time=time() - 10))
+
+    # act
+    GameOp(game).simulate(time())
+
+    # assert
+    assert victim.id not in game.entities
+    assert list(game.maze.decals.values()) == [[GRAVE_DECAL, victim.direction, game.tick]]
+
+
+def test_decals_are_bounded():
+    # arrange
+    maze = Maze(MAX_DECALS + 10, 1)
+
+    # act
+    for x in range(maze.width):
+        MazeOp(maze).add_decal(x, 0, GRAVE_DECAL, LEFT, x)
+
+    # assert
+    assert len(maze.decals) == MAX_DECALS
+    assert maze.decal_pos(next(iter(maze.decals))) == (10, 0)
+
+
+def test_serve_collects_handler_metrics(server):
+    # act
+    server.serve(PingRequest())
+    server.serve(PingRequest())
+    server.serve(MoveCharRequest(game_id=42))
+
+    # assert
+    assert server.metrics.counter('requests_total', type='PingRequest').value == 2
+    assert server.metrics.histogram('request_seconds', type='PingRequest').count == 2
+    assert server.metrics.counter('request_errors_total', type='MoveCharRequest').value == 1
+
+
+def test_batch_request(client, server, transport):
+    # arrange
+    client.fetch_game()
+    transport.sync()
+    char = client.game.units_by_player[client.player_id][0]
+    target = next(cell for cell in server.get_pathfinder(client.game_id).walkable if max(abs(cell[0] - char.x), abs(cell[1] - char.y)) == 1)
+
+    # act
+    client.move_char(char.id, *target)
+    client.ping()
+    client.fetch_game()
+    client.batch_outgoing()
+    batched = list(client.connection.outgoing)
+    transport.sync()
+
+    # assert
+    assert len(batched) == 1 and isinstance(batched[0], BatchRequest)
+    assert server.metrics.counter('requests_total', type='BatchRequest').value == 1
+    assert char.pos == target
+    assert client.last_ping_time is not None
+
+
+def test_batched_ping_reports_rtt(client, server, transport):
+    # arrange
+    client.ping()
+    transport.sync()
+    measured = client.last_ping_time
+    client.tracing = True
+
+    # act
+    client.ping()
+    client.fetch_game()
+    client.batch_outgoing()
+    transport.sync()
+
+    # assert
+    assert transport.server_connection.rtt == measured
+
+
+def test_expose_metrics(client, server):
+    # arrange
+    server.serve(PingRequest())
+    server.simulate(client.game_id)
+
+    # act
+    text = server.expose_metrics()
+
+    # assert
+    assert 'figack_requests_total{type="PingRequest"} 1' in text
+    assert 'figack_tick_seconds_count 1' in text
+    assert f'figack_connection_outgoing_queue{{game_id="{client.game_id}",player_id="{client.player_id}"}} 0' in text
+    assert 'figack_games 1' in text
+
+
+def test_profile_single_game(client, server):
+    # arrange
+    other_game_id = server.serve(CreateGameRequest(player_name='other')).game_id
+    server.profiler.start(game_id=client.game_id)
+
+    # act
+    server.simulate(client.game_id)
+    server.serve(JoinGameRequest(game_id=other_game_id, player_name='other2'))
+    stats = server.profiler.stop()
+
+    # assert
+    assert 'simulate' in stats
+    assert 'add_player' not in stats
+    assert not server.profiler.active
+
+
+def test_trace_request(client, server, transport):
+    # arrange
+    client.tracing = True
+
+    # act
+    client.fetch_game()
+    transport.sync()
+    transport.server_connection.outgoing.append(TraceTimings(1, {'encode': 0.001, 'send': 0.002}))
+    transport.sync()
+
+    # assert
+    assert client.game
+    assert not client.pending_traces
+    summary = client.trace_stats.summary()
+    assert summary['encode'][0] == 0.001
+    assert {'rtt', 'network', 'serve', 'queue'} <= set(summary)
+
+
+def test_clock_sync_estimates_offset_and_drift():
+    # arrange
+    clock = ClockSync()
+    offset, drift = 100.0, 0.001
+
+    # act
+    for i in range(CLOCK_SAMPLES):
+        t0 = 1000.0 + i * 5
+        delay = 0.05 if i % 2 else 0.5  # every other sample got queued on the way back
+        server_time = t0 + 0.025 + offset + drift * (t0 - 1000)
+        clock.add_sample(t0, server_time, t0 + delay)
+
+    # assert
+    assert clock.drift == pytest.approx(drift, rel=0.01)
+    assert clock.server_time(1100.0) == pytest.approx(1100.0 + offset + drift * 100, abs=0.001)
+
+
+def test_ping_syncs_clock(client, server, transport):
+    # act
+    client.ping()
+    transport.sync()
+
+    # assert
+    assert client.clock.synced
+    assert abs(client.server_now() - time()) < 0.01
+
+
+def free_neighbour(game, unit, exclude=()):
+    return next(cell for cell in sorted(GameOp(game).walkable_cells) if cell not in exclude and GameOp(game).can_move(unit, *cell, game.tick + MOVE_COOLDOWN))
+
+
+def test_move_is_predicted(client, server, transport):
+    # arrange
+    client.fetch_game()
+    transport.sync()
+    char = client.char
+    target = free_neighbour(client.game, char)
+
+    # act
+    client.move_char(char.id, *target)
+    predicted_pos = char.pos
+    client.fetch_game()
+    transport.sync()
+
+    # assert
+    assert predicted_pos == target
+    assert char.pos == target
+    assert server.get_game(client.game_id).entities[char.id].pos == target
+    assert not client.pending_inputs
+
+
+def test_move_during_cooldown_is_not_predicted(client, server, transport):
+    # arrange
+    client.fetch_game()
+    transport.sync()
+    char = client.char
+    start = char.pos
+    first = free_neighbour(client.game, char)
+    client.move_char(char.id, *first)
+    second = free_neighbour(client.game, char, exclude=(start, ))
+
+    # act
+    client.move_char(char.id, *second)  # the move cooldown is still on
+    predicted_pos = char.pos
+    client.fetch_game()
+    transport.sync()
+
+    # assert
+    assert predicted_pos == first
+    assert char.pos == first
+    assert server.get_game(client.game_id).entities[char.id].pos == first
+    assert not client.pending_inputs
+
+
+def test_prediction_survives_unacked_update(client, server, transport):
+    # arrange
+    client.fetch_game()
+    transport.sync()
+    char = client.char
+    start = char.pos
+    target = free_neighbour(client.game, char)
+    client.move_char(char.id, *target)  # not sent yet
+
+    # act
+    client.connection.incoming += transport.transfer([server.game_response(client.game_id, client.player_id)])
+    client.process_connection()
+
+    # assert
+    assert server.get_game(client.game_id).entities[char.id].pos == start
+    assert char.pos == target
+    assert len(client.pending_inputs) == 1
+
+
+def test_remote_units_are_interpolated():
+    # arrange
+    client = Client(1, 1, Connection())
+    now = time()
+    client.snapshots.append((now - client.interpolation_delay - 0.5, {10: (1, 1), 11: (1, 1)}))
+    client.snapshots.append((now - client.interpolation_delay + 0.5, {10: (2, 3), 11: (9, 9), 12: (5, 5)}))
+
+    # act
+    positions = client.interpolated_positions()
+
+    # assert
+    assert positions[10] == pytest.approx((1.5, 2), abs=0.01)
+    assert positions[11] == (9, 9)  # teleported
+    assert positions[12] == (5, 5)  # just appeared
+
+
+def test_own_changes_are_urgent(client, server):
+    # arrange
+    other_id = server.serve(JoinGameRequest(game_id=client.game_id, player_name='other')).player_id
+    other = server.connect(client.game_id, other_id)
+    game = server.get_game(client.game_id)
+    for y in range(game.maze.height):
+        for x in range(game.maze.width):
+            game.set_visibility(other_id, x, y, 0)
+
+    # act
+    server.mark_dirty(client.game_id, client.player_id)
+
+    # assert
+    conn = server.get_connection(client.game_id, client.player_id)
+    assert conn.dirty and conn.urgent
+    assert other.dirty and not other.urgent
+
+
+def test_disconnect_keeps_the_replacing_connection(client, server):
+    # arrange
+    stale = server.get_connection(client.game_id, client.player_id)
+    fresh = server.connect(client.game_id, client.player_id)
+
+    # act
+    silent = server.silent_connections(time() + 1)
+    left_connected = server.disconnect(stale)
+    left_empty = server.disconnect(fresh)
+
+    # assert
+    assert silent == [fresh]
+    assert left_connected
+    assert not left_empty
+    assert server.get_connection(client.game_id, client.player_id) is None
+
+
+def test_snapshot_is_not_changed_by_the_client(client, server, transport):
+    # arrange
+    client.fetch_game()
+    transport.sync()
+    char = client.char
+    start = char.pos
+    target = free_neighbour(client.game, char)
+
+    # act
+    snapshot = ClientSnapshot(client)
+    client.move_char(char.id, *target)
+
+    # assert
+    assert client.char.pos == target
+    assert snapshot.char.pos == start
+    assert snapshot.game.visibility[client.player_id] != client.game.visibility[client.player_id]
+
+
+def test_client_publishes_snapshots(client, server, transport):
+    # arrange
+    server.serve(JoinGameRequest(client.game_id, 'other'))
+    client.publish_snapshots = True
+    client.fetch_game()
+    transport.sync()
+    fetched = client.snapshot
+    target = free_neighbour(client.game, client.char)
+
+    # act
+    client.move_char(client.char.id, *target)
+    client.publish()
+    moved = client.snapshot
+    client.publish()
+
+    # assert
+    assert fetched and fetched.char.pos != target
+    assert moved is not fetched and moved.char.pos == target
+    assert client.snapshot is moved
+    assert list(moved.game.visibility) == [client.player_id]
+    assert client.snapshot.char.pos == target
+
+
+def test_client_tells_listeners_of_entities_coming_and_going(client, server, transport):
+    # arrange
+    class Listener:
+        def __init__(self):
+            self.added, self.removed = [], []
+
+        def entity_added(self, entity):
+            self.added.append(entity.id)
+
+        def entity_removed(self, entity):
+            self.removed.append(entity.id)
+
+    listener = Listener()
+    client.entity_listeners.append(listener)
+    client.fetch_game()
+    transport.sync()
+    char_id = client.char.id
+    game = server.get_game(client.game_id)
+    server.serve(JoinGameRequest(game_id=client.game_id, player_name='other'))
+    other = next(unit for unit in game.units if unit.id != char_id)
+
+    # act
+    client.fetch_game()
+    transport.sync()
+    GameOp(game).remove_entity(other)
+    client.fetch_game()
+    transport.sync()
+
+    # assert
+    assert listener.added == [char_id, other.id]
+    assert listener.removed == [other.id]
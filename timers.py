@@ -0,0 +1,80 @@
+WHEEL_SLOTS = 64
+WHEEL_LEVELS = 4
+
+
+class TimerWheel:
+    """ Hierarchical timer wheel counting game ticks. Level 0 has one slot per tick,
+        every next level one slot per revolution of the previous level; timers
+        cascade down as their time comes. Checking a timer is a dict lookup and
+        advancing only touches the slots that are due. """
+
+    def __init__(self, tick=0):
+        self.tick = tick
+        self._wheels = [[[] for _ in range(WHEEL_SLOTS)] for _ in range(WHEEL_LEVELS)]
+        self._overflow = []
+        self._timers = {}  # key -> (deadline, callback)
+
+    def schedule(self, key, delay, callback=None):
+        """ (Re)start the timer key to expire delay ticks from now. """
+        deadline = self.tick + max(delay, 1)
+        self._timers[key] = (deadline, callback)
+        self._insert(key, deadline)
+
+    def cancel(self, key):
+        self._timers.pop(key, None)  # stale slot entries are skipped on expiry
+
+    def active(self, key):
+        return key in self._timers
+
+    def remaining(self, key):
+        if key not in self._timers:
+            return 0
+        return self._timers[key][0] - self.tick
+
+    def __len__(self):
+        return len(self._timers)
+
+    def _insert(self, key, deadline):
+        delta = deadline - self.tick
+        span = 1
+        for level in range(WHEEL_LEVELS):
+            if delta < span * WHEEL_SLOTS:
+                self._wheels[level][(deadline // span) % WHEEL_SLOTS].append((key, deadline))
+                return
+            span *= WHEEL_SLOTS
+        self._overflow.append((key, deadline))
+
+    def advance(self, tick):
+        """ Move the clock to tick, firing callbacks of the expired timers.
+            Returns the expired keys. """
+        expired = []
+        while self.tick < tick:
+            self.tick += 1
+
+            # cascade higher levels, the highest first so its timers may cascade further
+            for level in reversed(range(1, WHEEL_LEVELS)):
+                span = WHEEL_SLOTS ** level
+                if self.tick % span:
+                    continue
+                if level == WHEEL_LEVELS - 1:
+                    entries, self._overflow = self._overflow, []
+                    for key, deadline in entries:
+                        self._insert(key, deadline)
+                slot = self._wheels[level][(self.tick // span) % WHEEL_SLOTS]
+                entries = slot[:]
+                slot.clear()
+                for key, deadline in entries:
+                    if self._timers.get(key, (None,))[0] == deadline:
+                        self._insert(key, deadline)
+
+            slot = self._wheels[0][self.tick % WHEEL_SLOTS]
+            entries = slot[:]
+            slot.clear()
+            for key, deadline in entries:
+                timer = self._timers.get(key)
+                if timer and timer[0] == deadline:
+                    del self._timers[key]
+                    expired.append(key)
+                    if timer[1]:
+                        timer[1](key)
+        return expired
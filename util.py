@@ -1,7 +1,60 @@
 import collections
+import operator
+
+
+_object_fields = {}  # class -> names of its slots
+_object_getters = {}  # class -> getter of all slot values at once
+
+
+def object_fields(cls):
+    """ Names of the attributes declared in __slots__ throughout the class hierarchy. """
+    if cls not in _object_fields:
+        _object_fields[cls] = tuple(name for klass in reversed(cls.__mro__) for name in getattr(klass, '__slots__', ())
+                                    if name not in ('__dict__', '__weakref__'))
+    return _object_fields[cls]
+
+
+def object_state(obj):
+    """ Attributes of an object as a dict, whether it keeps them in __dict__ or __slots__. """
+    cls = type(obj)
+    fields = object_fields(cls)
+    if not fields:
+        return obj.__dict__
+    if hasattr(obj, '__dict__'):
+        state = {name: getattr(obj, name) for name in fields if hasattr(obj, name)}
+        state.update(obj.__dict__)
+        return state
+    if cls not in _object_getters:
+        _object_getters[cls] = operator.attrgetter(*fields) if len(fields) > 1 else lambda obj: (getattr(obj, fields[0]), )
+    return dict(zip(fields, _object_getters[cls](obj)))
 
 
 def object_update_from(dest, source):
     """ Universal update of an object either from dict or another object.
         The source id remains unchanged. """
-    dest.__dict__.update(source if isinstance(source, collections.abc.Mapping) else source.__dict__)
+    state = source if isinstance(source, collections.abc.Mapping) else object_state(source)
+    if object_fields(type(dest)):
+        for name, value in state.items():
+            setattr(dest, name, value)
+    else:
+        dest.__dict__.update(state)
+
+
+def percentile(values, p):
+    """ Nearest-rank percentile, p in 0..100. """
+    values = sorted(values)
+    if not values:
+        return 0
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+
+def changed_spans(old, new):
+    """ (y, first x, last x) of the changes in every row of a grid; all of it if the size differs. """
+    if old is None or len(old) != len(new) or any(len(old_row) != len(new_row) for old_row, new_row in zip(old, new)):
+        return [(y, 0, len(row) - 1) for y, row in enumerate(new) if row]
+    spans = []
+    for y, (old_row, new_row) in enumerate(zip(old, new)):
+        if old_row != new_row:
+            xs = [x for x, (a, b) in enumerate(zip(old_row, new_row)) if a != b]
+            spans.append((y, xs[0], xs[-1]))
+    return spans
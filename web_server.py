@@ -6,16 +6,31 @@ import asyncio
 import json
 import logging
 import os
+from time import perf_counter, time
 
 from messaging import Codec
+from metrics import SIZE_BUCKETS
+import profiling
 import model
+from ops import TICK_INTERVAL
 from protocol import *
 from server import Server
 
+HEARTBEAT = 10  # seconds between websocket pings, a missed pong closes the socket
+SILENCE_TIMEOUT = 30  # clients ping at least every few seconds, a silent one is gone
+REAP_INTERVAL = 5
+SIMULATE_INTERVAL = 0.5
+
 server = Server()
 
 codec = Codec(auto_register=True, globals=globals())
 
+sockets = {}  # connection -> its websocket
+simulate_tasks = {}  # game_id -> task simulating the game while it has connections
+
+encode_seconds = server.metrics.histogram('encode_seconds')
+frame_bytes = server.metrics.histogram('frame_bytes', buckets=SIZE_BUCKETS)
+
 
 async def handle_create(request):
     logging.debug('Create request')
@@ -32,39 +47,132 @@ async def handle_join(request):
     return aiohttp.web.json_response({'player_id': response.player_id})
 
 
-def broadcast_game_changes(connection, serer, game_id):
-    for conn in server.get_connections(game_id):
-        conn.outgoing.append(GetGameResponse(server.get_game(game_id)))
-    server.get_game(game_id).next_tick()
+async def handle_metrics(request):
+    return aiohttp.web.Response(text=server.expose_metrics(), content_type='text/plain')
+
+
+async def handle_profile(request):
+    if request.remote not in ('127.0.0.1', '::1'):
+        raise aiohttp.web.HTTPForbidden()
+    if server.profiler.active:
+        raise aiohttp.web.HTTPConflict(text='Profiling is already running')
+    seconds = float(request.rel_url.query.get('seconds', 10))
+    mode = request.rel_url.query.get('mode', profiling.CPROFILE)
+    if mode not in profiling.MODES:
+        raise aiohttp.web.HTTPBadRequest(text=f'Unknown mode {mode}, expected one of {", ".join(profiling.MODES)}')
+    game_id = int(request.rel_url.query['game_id']) if 'game_id' in request.rel_url.query else None
+    raw = request.rel_url.query.get('format') == 'raw'
+    logging.info(f'Profiling mode={mode} game_id={game_id} for {seconds} s')
+
+    server.profiler.start(mode, game_id)
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        result = server.profiler.stop(raw=raw)
+    if raw:
+        return aiohttp.web.Response(body=result, content_type='application/octet-stream')
+    return aiohttp.web.Response(text=result, content_type='text/plain')
+
+
+async def handle_add_bots(request):
+    game_id = int(request.rel_url.query['game_id'])
+    count = int(request.rel_url.query.get('count', 1))
+    logging.debug(f'Add bots request with game_id={game_id} count={count}')
+    bot_ids = server.add_bots(game_id, count)
+    return aiohttp.web.json_response({'unit_ids': bot_ids})
+
+
+def broadcast_game_changes(server, game_id, player_id=None):
+    # sent by write() at the rate each connection can take
+    server.mark_dirty(game_id, player_id)
 
 
 async def read(ws, connection, server, game_id):
     async for msg in ws:
         if msg.type == aiohttp.WSMsgType.TEXT:
+            connection.last_seen_ts = time()
             request = codec.decode(msg.data)
             logging.debug('IN  %s', msg.data)
+            stamp_arrival(request, time())
             connection.incoming.append(request)
             server.process_connections()  # TODO: do it somewhere outside
-            broadcast_game_changes(connection, server, game_id)
+            broadcast_game_changes(server, game_id, connection.player_id)
         elif msg.type == aiohttp.WSMsgType.ERROR:
             logging.exception(ws.exception())
 
 
-async def write(ws, connection):
+def stamp_arrival(request, now):
+    if isinstance(request, TracedRequest):
+        request.received_at = now
+    elif isinstance(request, BatchRequest):
+        for sub_request in request.requests:
+            stamp_arrival(sub_request, now)
+
+
+def traced_responses(message):
+    if isinstance(message, TracedResponse):
+        yield message
+    elif isinstance(message, BatchResponse):
+        yield from (response for response in message.responses if isinstance(response, TracedResponse))
+
+
+async def write(ws, connection, server):
     while True:
+        now = time()
+        if connection.update_due(now):
+            connection.outgoing.append(server.game_response(connection.game_id, connection.player_id))
+            connection.updated(now)
         while connection.outgoing:
             message = connection.outgoing.pop(0)
+            traces = list(traced_responses(message))
+            for trace in traces:
+                trace.timings['tick'] = time() - trace.server_time
+            start = perf_counter()
             data = codec.encode(message)
+            encoded = perf_counter()
+            encode_seconds.observe(encoded - start)
+            frame_bytes.observe(len(data))
             logging.debug('OUT %s', data)
             await ws.send_str(data)
+            sent = perf_counter()
+            connection.report_send(len(data), sent - encoded, update=isinstance(message, GetGameResponse))
+            for trace in traces:
+                connection.outgoing.append(TraceTimings(trace.trace_id, {'encode': encoded - start, 'send': sent - encoded}))
         await asyncio.sleep(0)
 
 
-async def simulate(connection, server, game_id):
+async def simulate(server, game_id):
+    """ Tick the game on a fixed cadence, so cooldowns take the same time however much the clients send. """
+    ticks_per_simulate = max(round(SIMULATE_INTERVAL / TICK_INTERVAL), 1)
+    tick = 0
+    next_ts = time()
+    while True:
+        if tick % ticks_per_simulate == 0 and server.simulate(game_id):
+            broadcast_game_changes(server, game_id)
+        server.next_tick(game_id)
+        tick += 1
+        next_ts += TICK_INTERVAL
+        await asyncio.sleep(max(next_ts - time(), 0))
+
+
+async def reap_silent_connections():
     while True:
-        if server.simulate(game_id):
-            broadcast_game_changes(connection, server, game_id)
-        await asyncio.sleep(0.5)
+        await asyncio.sleep(REAP_INTERVAL)
+        for conn in server.silent_connections(time() - SILENCE_TIMEOUT):
+            logging.info('Closing silent connection game_id=%s player_id=%s', conn.game_id, conn.player_id)
+            if conn in sockets:
+                await sockets[conn].close()  # handle_connect cleans up after it
+            else:
+                server.disconnect(conn)
+
+
+async def start_reaper(app):
+    app['reaper'] = asyncio.create_task(reap_silent_connections())
+
+
+async def stop_background_tasks(app):
+    for task in [app['reaper']] + list(simulate_tasks.values()):
+        task.cancel()
 
 
 async def handle_connect(request):
@@ -72,15 +180,26 @@ async def handle_connect(request):
     player_id = int(request.rel_url.query['player_id'])
     logging.debug(f'Connect request with game_id={game_id} player_id={player_id}')
 
+    replaced = server.get_connection(game_id, player_id)
+    if replaced in sockets:
+        await sockets[replaced].close()
     connection = server.connect(game_id, player_id)
 
-    ws = aiohttp.web.WebSocketResponse()
+    ws = aiohttp.web.WebSocketResponse(heartbeat=HEARTBEAT)
     await ws.prepare(request)
+    sockets[connection] = ws
 
-    read_task = asyncio.create_task(read(ws, connection, server, game_id))
-    write_task = asyncio.create_task(write(ws, connection))
-    simulate_task = asyncio.create_task(simulate(connection, server, game_id))
-    await asyncio.gather(read_task, write_task, simulate_task)
+    if game_id not in simulate_tasks:
+        simulate_tasks[game_id] = asyncio.create_task(simulate(server, game_id))
+    write_task = asyncio.create_task(write(ws, connection, server))
+    try:
+        await read(ws, connection, server, game_id)  # until the socket closes
+    finally:
+        write_task.cancel()
+        del sockets[connection]
+        if not server.disconnect(connection) and game_id in simulate_tasks:
+            logging.debug(f'Last player left game_id={game_id}')
+            simulate_tasks.pop(game_id).cancel()
 
     logging.debug('websocket connection closed')
     return ws
@@ -101,9 +220,14 @@ def main():
                     os.unlink('server.json')
 
     app = aiohttp.web.Application()
+    app.on_startup.append(start_reaper)
+    app.on_cleanup.append(stop_background_tasks)
     app.router.add_get('/create', handle_create)
     app.router.add_get('/join', handle_join)
     app.router.add_get('/connect', handle_connect)
+    app.router.add_get('/bots', handle_add_bots)
+    app.router.add_get('/metrics', handle_metrics)
+    app.router.add_get('/admin/profile', handle_profile)
 
     try:
         aiohttp.web.run_app(app)